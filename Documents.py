@@ -0,0 +1,262 @@
+# This file saves pads (their pages, and the staves and music objects on them)
+# to document files, and loads them back.
+#
+# A document is written one page at a time, so a pad can be streamed to a file
+# (or a batch job can stream pages out of one) without every page being in
+# memory at once.  Each page is a record of its own, prefixed with its length,
+# so that pages can be skipped without being parsed, and an index of where
+# each page starts is written at the end, so that any one page can be read
+# directly.
+#
+# The document file layout is:
+#   magic ('SPPD'), format version and header length (little-endian uint32s)
+#   header: JSON with the page size
+#   records: a tag ('PAGE' or 'INDX') and the length of the record's data (a
+#            little-endian uint32), followed by its data
+#   trailer: 'SPIX' and the offset of the index record (a little-endian
+#            uint64), which is left off until the document is closed
+#
+# A page record holds the number of staves (a uint32), a row of STAFFDTYPE
+# for each staff, and then a row of OBJECTDTYPE for each of the staves'
+# descendants: the objects of the first staff in tree order (each after its
+# parent), then those of the second, and so on.  The index record holds the
+# offset of each page record (little-endian uint64s).
+#
+# Only what an object was built with is saved (where notes are on their
+# stems, for example, but not their rects), and loading a page sets objects up
+# from it directly (see Staff.loadChildren), rather than by adding them one at
+# a time as they were drawn.
+
+import os
+import gc
+import json
+import struct
+import numpy as np
+
+import MusicObjects as mus
+from Pages import Page
+
+MAGIC = 'SPPD'
+VERSION = 1
+_PREFIX = struct.Struct('<4sII')
+_RECORD = struct.Struct('<4sI')
+_TRAILER = struct.Struct('<4sQ')
+_COUNT = struct.Struct('<I')
+PAGETAG = 'PAGE'
+INDEXTAG = 'INDX'
+TRAILERTAG = 'SPIX'
+
+# The classes of object that are saved (numbered by their position)
+CLASSES = [mus.Note,mus.Stem,mus.Barline,mus.Accidental,mus.Accent]
+_classNumbers = dict((cls,i) for i, cls in enumerate(CLASSES))
+
+STAFFDTYPE = np.dtype([('yMiddle','<f8'),('width','<f8'),('objects','<u4')])
+# The line column holds a note's line or a stem's base line, and the xPos
+# column holds a note's, stem's or barline's x position
+OBJECTDTYPE = np.dtype([('class','u1'),('parent','<i4'),('line','<i4'),('xPos','<f8'),
+                        ('style','i1'),('direction','i1'),('length','<i4')])
+
+# The columns after class and parent, for each class of object
+def _noteRow(note):
+	return (note._line,note._xPos,note._style,0,0)
+
+def _stemRow(stem):
+	return (stem._baseLine,stem._xPos,0,stem._direction,stem._length)
+
+def _barlineRow(barline):
+	return (0,barline._xPos,barline._style,0,0)
+
+def _styleRow(obj):
+	return (0,0,obj._style,0,0)
+
+_rowFunctions = {
+	mus.Note: _noteRow,
+	mus.Stem: _stemRow,
+	mus.Barline: _barlineRow,
+	mus.Accidental: _styleRow,
+	mus.Accent: _styleRow,
+}
+
+def _objectRows(obj,parent,rows):
+	for child in obj._children:
+		rows.append((_classNumbers[child.__class__],parent) + _rowFunctions[child.__class__](child))
+		_objectRows(child,len(rows)-1,rows)
+
+def pageRecord(page):
+	"""
+	  Returns the data of a page's record.
+	"""
+	staves = np.zeros(len(page.staves),STAFFDTYPE)
+	rows = []
+	for i, staff in enumerate(page.staves):
+		staffRows = []
+		_objectRows(staff,-1,staffRows)
+		staves[i] = (staff._yMiddle,staff._width,len(staffRows))
+		rows += staffRows
+	objects = np.array(rows,OBJECTDTYPE)
+	return _COUNT.pack(len(staves)) + staves.tostring() + objects.tostring()
+
+def loadPage(record,pad):
+	"""
+	  Builds a page of the pad from the data of its record.
+	"""
+	staffCount = _COUNT.unpack_from(record)[0]
+	staves = np.frombuffer(record,STAFFDTYPE,staffCount,_COUNT.size)
+	objects = np.frombuffer(record,OBJECTDTYPE,int(np.sum(staves['objects'])),_COUNT.size+staves.nbytes)
+
+	page = Page(pad,empty=True)
+	first = 0
+	for yMiddle, width, count in staves.tolist():
+		staff = page.addStaff(yMiddle,width)
+		rows = objects[first:first+count]
+		staff.loadChildren([CLASSES[number] for number in rows['class']],rows)
+		first += count
+	return page
+
+class Writer:
+	"""
+	  Writes a document one page at a time.  The document is written next to
+	  the given path, and only moved there when it is closed, so that readers
+	  never see a partial document.
+	"""
+	def __init__(self,path,pageSize):
+		self.path = path
+		self._file = open(path + '.tmp','wb')
+		header = json.dumps({'pageSize':list(pageSize)}).encode('utf-8')
+		self._file.write(_PREFIX.pack(MAGIC,VERSION,len(header)))
+		self._file.write(header)
+		self._offsets = []
+
+	def write(self,page):
+		self._offsets.append(self._file.tell())
+		_writeRecord(self._file,PAGETAG,pageRecord(page))
+
+	def close(self):
+		indexOffset = self._file.tell()
+		_writeRecord(self._file,INDEXTAG,np.array(self._offsets,'<u8').tostring())
+		self._file.write(_TRAILER.pack(TRAILERTAG,indexOffset))
+		self._file.close()
+		os.rename(self.path + '.tmp',self.path)
+
+	def discard(self):
+		self._file.close()
+		os.remove(self.path + '.tmp')
+
+def _writeRecord(f,tag,data):
+	f.write(_RECORD.pack(tag,len(data)))
+	f.write(data)
+
+def write(path,pages,pageSize):
+	"""
+	  Writes every page to a document.
+	"""
+	writer = Writer(path,pageSize)
+	try:
+		for page in pages:
+			writer.write(page)
+	except:
+		writer.discard()
+		raise
+	writer.close()
+
+def _readPrefix(f):
+	fileMagic, version, headerLength = _PREFIX.unpack(f.read(_PREFIX.size))
+	if fileMagic != MAGIC:
+		raise IOError(f.name + ' is not a ' + MAGIC + ' file')
+	if version != VERSION:
+		raise IOError(f.name + ' is a document of an unknown version')
+	return json.loads(f.read(headerLength).decode('utf-8'))
+
+def _readRecord(f):
+	"""
+	  Returns the tag and data of the record that starts at the file's
+	  position, or (None,None) at the end of the records (including a record
+	  that is still being written).
+	"""
+	prefix = f.read(_RECORD.size)
+	if len(prefix) < _RECORD.size or prefix[:len(TRAILERTAG)] == TRAILERTAG:
+		return None, None
+	tag, length = _RECORD.unpack(prefix)
+	data = f.read(length)
+	if len(data) < length:
+		return None, None
+	return tag, data
+
+def _pageOffsets(f):
+	"""
+	  Returns the offsets of the page records, from the index if the document
+	  has one, or else by skipping from record to record.
+	"""
+	f.seek(0,os.SEEK_END)
+	size = f.tell()
+	f.seek(size-_TRAILER.size)
+	tag, indexOffset = _TRAILER.unpack(f.read(_TRAILER.size))
+	if tag == TRAILERTAG:
+		f.seek(indexOffset)
+		tag, data = _readRecord(f)
+		return np.frombuffer(data,'<u8').tolist()
+
+	f.seek(0)
+	_readPrefix(f)
+	offsets = []
+	while f.tell()+_RECORD.size <= size:
+		offset = f.tell()
+		tag, length = _RECORD.unpack(f.read(_RECORD.size))
+		if tag == PAGETAG and offset+_RECORD.size+length <= size:
+			offsets.append(offset)
+		f.seek(length,os.SEEK_CUR)
+	return offsets
+
+def pageCount(path):
+	f = open(path,'rb')
+	try:
+		_readPrefix(f)
+		return len(_pageOffsets(f))
+	finally:
+		f.close()
+
+def readPage(path,number,pad):
+	"""
+	  Reads only the page with the given number (counting from zero) from a
+	  document, as a page of the pad.
+	"""
+	f = open(path,'rb')
+	try:
+		_readPrefix(f)
+		f.seek(_pageOffsets(f)[number])
+		tag, data = _readRecord(f)
+	finally:
+		f.close()
+	return loadPage(data,pad)
+
+def readPages(path,pad):
+	"""
+	  Reads the pages of a document in order, one at a time (this is a
+	  generator), as pages of the pad.
+	"""
+	f = open(path,'rb')
+	try:
+		_readPrefix(f)
+		while True:
+			tag, data = _readRecord(f)
+			if tag is None:
+				break
+			if tag == PAGETAG:
+				yield loadPage(data,pad)
+	finally:
+		f.close()
+
+def read(path,pad):
+	"""
+	  Reads every page of a document, as pages of the pad.
+	"""
+	# The garbage collector is paused meanwhile, since building a great many
+	# objects at once would otherwise set off full collections again and
+	# again
+	enabled = gc.isenabled()
+	gc.disable()
+	try:
+		return list(readPages(path,pad))
+	finally:
+		if enabled:
+			gc.enable()
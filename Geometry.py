@@ -0,0 +1,168 @@
+# This file contains the geometry types used by the music objects.  They behave
+# like the pygame types they replace (integer rectangles, with coordinates
+# truncated towards zero), so that the recognition and placement code can be
+# used without importing pygame or opening a display.  There is also a grid
+# index, for finding the objects near a point or rectangle quickly.
+
+import math
+
+def _half(value):
+	# Integer division that truncates towards zero, as pygame does
+	return int(value/2.0)
+
+class Rect(object):
+	"""
+	  An integer rectangle with the parts of the pygame.Rect interface that the
+	  music objects use.
+	"""
+	__slots__ = ('x','y','w','h')
+
+	def __init__(self,x,y,w,h):
+		self.x = int(x)
+		self.y = int(y)
+		self.w = int(w)
+		self.h = int(h)
+
+	def __repr__(self):
+		return '<rect(%d, %d, %d, %d)>' % (self.x,self.y,self.w,self.h)
+
+	def __eq__(self,other):
+		return (self.x,self.y,self.w,self.h) == (other.x,other.y,other.w,other.h)
+
+	def __ne__(self,other):
+		return not self == other
+
+	left = property(lambda self: self.x)
+	top = property(lambda self: self.y)
+	right = property(lambda self: self.x + self.w)
+	bottom = property(lambda self: self.y + self.h)
+	width = property(lambda self: self.w)
+	height = property(lambda self: self.h)
+	centerx = property(lambda self: self.x + _half(self.w))
+	centery = property(lambda self: self.y + _half(self.h))
+	center = property(lambda self: (self.centerx,self.centery))
+
+	def copy(self):
+		return Rect(self.x,self.y,self.w,self.h)
+
+	def move(self,dx,dy):
+		return Rect(self.x+int(dx),self.y+int(dy),self.w,self.h)
+
+	def union(self,rect):
+		left = min(self.x,rect.x)
+		top = min(self.y,rect.y)
+		return Rect(left,top,max(self.right,rect.right)-left,max(self.bottom,rect.bottom)-top)
+
+	def inflate_ip(self,dx,dy):
+		dx = int(dx)
+		dy = int(dy)
+		self.x -= _half(dx)
+		self.y -= _half(dy)
+		self.w += dx
+		self.h += dy
+
+	def collidepoint(self,point):
+		x = int(point[0])
+		y = int(point[1])
+		return self.x <= x < self.x + self.w and self.y <= y < self.y + self.h
+
+	def colliderect(self,rect):
+		# Empty rectangles never collide with anything
+		if self.w == 0 or self.h == 0 or rect.w == 0 or rect.h == 0:
+			return False
+		return (min(self.x,self.right) < max(rect.x,rect.right) and
+		        min(self.y,self.bottom) < max(rect.y,rect.bottom) and
+		        max(self.x,self.right) > min(rect.x,rect.right) and
+		        max(self.y,self.bottom) > min(rect.y,rect.bottom))
+
+class GridIndex(object):
+	"""
+	  A uniform grid of square cells, each of which holds the objects (anything
+	  with a _rect) whose rectangles overlap it.  The objects near a point or
+	  rectangle can then be found by looking only at the cells it covers, so a
+	  query costs O(k) for k nearby objects, however many objects there are.
+
+	  Objects must be updated whenever their rectangles change.
+	"""
+	# Rectangles are padded by this much when they are put in cells, so that
+	# objects that extend slightly past their (truncated) rectangles are found
+	MARGIN = 1
+
+	def __init__(self,cellSize):
+		self.cellSize = float(cellSize)
+		# Objects in each cell (keyed by (column,row)), and the range of cells
+		# that each object is in (its first and last cell)
+		self._cells = {}
+		self._objectCells = {}
+
+	def __len__(self):
+		return len(self._objectCells)
+
+	def __contains__(self,obj):
+		return obj in self._objectCells
+
+	def _cellRange(self,left,top,right,bottom):
+		# The first and last (column,row) of the cells an area covers
+		m = self.MARGIN
+		return ((int(math.floor((left-m)/self.cellSize)),int(math.floor((top-m)/self.cellSize))),
+		        (int(math.floor((right+m)/self.cellSize)),int(math.floor((bottom+m)/self.cellSize))))
+
+	def _rectRange(self,rect):
+		return self._cellRange(min(rect.left,rect.right),min(rect.top,rect.bottom),
+		                       max(rect.left,rect.right),max(rect.top,rect.bottom))
+
+	def _cellsBetween(self,first,last):
+		return [(column,row) for column in range(first[0],last[0]+1) for row in range(first[1],last[1]+1)]
+
+	def update(self,obj):
+		"""
+		  Adds the object, or moves it to the cells its rectangle now covers.
+		"""
+		cells = self._rectRange(obj._rect)
+		oldCells = self._objectCells.get(obj)
+		if oldCells == cells:
+			return
+		if oldCells is not None:
+			self._removeFromCells(obj,oldCells)
+		for cell in self._cellsBetween(*cells):
+			self._cells.setdefault(cell,set()).add(obj)
+		self._objectCells[obj] = cells
+
+	def objects(self):
+		return self._objectCells.keys()
+
+	def remove(self,obj):
+		cells = self._objectCells.pop(obj,None)
+		if cells is not None:
+			self._removeFromCells(obj,cells)
+
+	def _removeFromCells(self,obj,cells):
+		for cell in self._cellsBetween(*cells):
+			objects = self._cells[cell]
+			objects.discard(obj)
+			if len(objects) == 0:
+				del self._cells[cell]
+
+	def nearRect(self,rect):
+		"""
+		  Returns the objects in the cells that the rectangle covers (a
+		  superset of the objects that intersect it).
+		"""
+		return self._near(*self._rectRange(rect))
+
+	def nearPoint(self,point):
+		return self._near(*self._cellRange(point[0],point[1],point[0],point[1]))
+
+	def _near(self,first,last):
+		if (last[0]-first[0]+1)*(last[1]-first[1]+1) > len(self._cells):
+			# A large area; it is quicker to check the cells that are in use
+			cells = [cell for cell in self._cells
+			         if first[0] <= cell[0] <= last[0] and first[1] <= cell[1] <= last[1]]
+		else:
+			cells = self._cellsBetween(first,last)
+		found = set()
+		for cell in cells:
+			objects = self._cells.get(cell)
+			if objects:
+				found.update(objects)
+		return found
@@ -0,0 +1,137 @@
+# This file contains the history of the changes made to a page's staves, so
+# that they can be undone and redone.
+#
+# The music objects record every change that they make to a staff's tree (see
+# MusicObject._record), as a small record that can be made or unmade on its
+# own: a child inserted into, or removed from, an object's children at an
+# index, or an attribute set from one value to another.  The changes made by
+# one action (such as adding a shape to the page, or an eraser stroke) make up
+# a command, and undoing or redoing a command just unmakes or remakes its
+# changes, in order, and then brings the changed objects' rects and index
+# entries up to date.  The time this takes depends only on the size of the
+# command, not on the size of the page, and nothing is ever copied.
+
+from collections import deque
+
+# TODO: put this into config file
+# Maximum number of changes kept in the history (the oldest commands are
+# forgotten first, but the last command is always kept)
+HISTORYLIMIT = 100000
+
+class History:
+	def __init__(self,limit=HISTORYLIMIT):
+		self.limit = limit
+		self._undo = deque()
+		self._redo = []
+		# The number of changes in the commands that are kept
+		self._size = 0
+		# The command being recorded, and how many begin()s it is inside
+		self._current = None
+		self._depth = 0
+
+	def __len__(self):
+		return self._size
+
+	def begin(self):
+		"""
+		  Starts a command: every change recorded until the matching end() is
+		  undone and redone together.  Commands can be nested, in which case
+		  the outermost one is recorded.
+		"""
+		if self._depth == 0:
+			self._current = []
+		self._depth += 1
+
+	def end(self):
+		self._depth -= 1
+		if self._depth > 0:
+			return
+		command = self._current
+		self._current = None
+		if len(command) == 0:
+			return
+		# A new command can't be followed by the ones that were undone
+		for undone in self._redo:
+			self._size -= len(undone)
+		self._redo = []
+		self._undo.append(command)
+		self._size += len(command)
+		while self._size > self.limit and len(self._undo) > 1:
+			self._size -= len(self._undo.popleft())
+
+	def record(self,change):
+		"""
+		  Adds a change to the command being recorded (or makes it a command
+		  of its own).
+		"""
+		if self._current is None:
+			self.begin()
+			self._current.append(change)
+			self.end()
+		else:
+			self._current.append(change)
+
+	def canUndo(self):
+		return len(self._undo) > 0
+
+	def canRedo(self):
+		return len(self._redo) > 0
+
+	def undo(self):
+		"""
+		  Undoes the last command.  Returns the staves and rects of the
+		  objects that it changed, before and after, so that they can be
+		  redrawn.
+		"""
+		# (Nothing can be undone in the middle of recording a command)
+		if not self.canUndo() or self._depth > 0:
+			return []
+		command = self._undo.pop()
+		self._redo.append(command)
+		return self._replay(list(reversed(command)),True)
+
+	def redo(self):
+		"""
+		  Redoes the last command that was undone, like undo.
+		"""
+		if not self.canRedo() or self._depth > 0:
+			return []
+		command = self._redo.pop()
+		self._undo.append(command)
+		return self._replay(command,False)
+
+	def _replay(self,changes,undo):
+		# The objects in the changes (the ones changed, and the ones moved
+		# between them)
+		objects = []
+		seen = set()
+		for change in changes:
+			for obj in change[1:]:
+				if hasattr(obj,'restore') and obj not in seen:
+					seen.add(obj)
+					objects.append(obj)
+
+		rects = _rects(objects)
+		for change in changes:
+			change[1].applyChange(change,undo)
+		# Objects that are out of the tree are taken out of the index first,
+		# so that any of their (former) descendants that are back in the tree
+		# are put back into it; parents are updated before their children,
+		# which are positioned relative to them.
+		inTree = []
+		for obj in objects:
+			depth = obj.treeDepth()
+			if depth is None:
+				obj.restore(False)
+			else:
+				inTree.append((depth,obj))
+		inTree.sort(key=lambda entry: entry[0])
+		for depth, obj in inTree:
+			obj.restore(True)
+		return rects + _rects(objects)
+
+def _rects(objects):
+	rects = []
+	for obj in objects:
+		rects += obj.staffRects()
+	return rects
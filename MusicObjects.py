@@ -1,9 +1,11 @@
-import pygame
+import weakref
 from numpy import *
+from Geometry import Rect, GridIndex
 STAFFSPACING = 15.0
 MINSTEMLENGTH = 6 # minimum stem length, in lines and spaces.
+# Size of the cells of the grids that each staff indexes its contents with
+INDEXCELLSIZE = STAFFSPACING*2
 
-BLACK = pygame.Color("black")
 TYPE_ANY = -1
 
 NOTE_FILLED = -1
@@ -42,11 +44,13 @@ these are optional, depending on the object. The order is:
   style/type/etc
   children
 
+Drawing is not done here, but in Render.py, so that these objects can be used
+without pygame.
+
 Finally, there is a standard order of functions (for readability):
   Basic Functions:
     __init__
 	addChild
-    draw
   Distance: TODO: MAYBE REMOVE THESE FUNCTIONS!
     dist
     _distVertLine
@@ -67,17 +71,25 @@ Finally, there is a standard order of functions (for readability):
     (any other functions that apply to this object, such as attribute modifiers)
 """
 
-class MusicObject:
+class MusicObject(object):
 	"""
 	  A base class for musical objects (WITH semantic meaning; i.e., not just a
 	  circle, but a note; not just a line, but a stem or a barline).  The
 	  base class just acts like a single point with no meaning, and should not
 	  be used by itself.
+
+	  There can be a great many notes and accents in a score, so their classes
+	  have __slots__ (and this one does, so that theirs take effect).  Other
+	  classes have no __slots__, so their objects can have any attributes.
 	"""
+	__slots__ = ('_rect','_parent','_children','__weakref__')
+
 	def __init__(self,parent):
-		self._rect = pygame.Rect(0,0,0,0)
+		self._rect = Rect(0,0,0,0)
 		self._parent = parent
-		self._children = []
+		# Most objects never have children, so they share an empty tuple until
+		# they do (see addChild)
+		self._children = ()
 		# Since the highest level objects have "None" type parent, this
 		# prevents errors.
 		if self._parent:
@@ -88,11 +100,185 @@ class MusicObject:
 		  This should be overwritten if the object should do something special
 		  when a child is added (such as recompute clusters, stem length, etc)
 		"""
-		self._children.append(obj)
+		self._insertChild(len(self._children),obj)
+		self._indexTree(obj)
+
+	# Changes to the tree are made through these, so that they are recorded in
+	# the staff's history (if it has one), and can be undone (see History)
+	def _record(self,change):
+		staff = self._staff()
+		if staff and staff._history is not None:
+			staff._history.record(change)
+
+	def _insertChild(self,index,obj):
+		if len(self._children) == 0:
+			self._children = []
+		self._children.insert(index,obj)
+		self._record(('insert',self,index,obj))
+
+	def _removeChild(self,obj):
+		index = self._children.index(obj)
+		del self._children[index]
+		self._record(('remove',self,index,obj))
+
+	def _set(self,name,value):
+		self._record(('set',self,name,getattr(self,name,None),value))
+		setattr(self,name,value)
+
+	# These are what History undoes and redoes recorded changes with
+	def applyChange(self,change,undo):
+		"""
+		  Makes (or, if undo is True, unmakes) a change that was recorded by
+		  this object, without recording it again.
+		"""
+		if change[0] == 'set':
+			setattr(self,change[2],change[3] if undo else change[4])
+		elif (change[0] == 'insert') != undo:
+			if len(self._children) == 0:
+				self._children = []
+			self._children.insert(change[2],change[3])
+		else:
+			del self._children[change[2]]
+
+	def treeDepth(self):
+		"""
+		  Returns the number of ancestors the object has, or None if it isn't
+		  in a staff's tree.
+		"""
+		depth = 0
+		obj = self
+		while obj._parent:
+			if obj not in obj._parent._children:
+				return None
+			depth += 1
+			obj = obj._parent
+		if obj.__class__ != Staff:
+			return None
+		return depth
+
+	def restore(self,inTree):
+		"""
+		  Brings the object (and its descendants) up to date in the staff's
+		  index after changes to the tree have been undone or redone, and, if
+		  it is in the tree, recomputes its position.
+		"""
+		staff = self._staff()
+		if staff is None:
+			return
+		if inTree:
+			self._refresh()
+			for descendant in self._descendants():
+				staff._register(descendant)
+		else:
+			for descendant in self._descendants():
+				staff._unregister(descendant)
+
+	def staffRects(self):
+		"""
+		  Returns the staff of the object and the rect of the object and each
+		  of its descendants, as (staff, rect) pairs, or nothing if it isn't
+		  on a staff (or is one).
+		"""
+		staff = self._staff()
+		if staff is None or staff is self:
+			return []
+		return [(staff,descendant._rect.copy()) for descendant in self._descendants()]
+
+	def _refresh(self):
+		"""
+		  This should be overwritten if anything about the object (such as its
+		  rect) is computed from its attributes or its parent's.
+		"""
+		pass
 
-	def draw(self,canvas,scale):
+	# Saved pages (see Documents.py) are loaded with fromRow, in place of
+	# __init__, so that nothing is laid out again, indexed or recorded while
+	# the objects are added (see Staff.loadChildren)
+	@classmethod
+	def fromRow(cls,parent,row):
+		"""
+		  Makes an object from its row of a saved page, and adds it to the
+		  parent's children (after the others).
+		"""
+		obj = cls.__new__(cls)
+		obj._rect = Rect(0,0,0,0)
+		obj._parent = parent
+		obj._children = ()
+		obj._loadRow(row)
+		parent.addLoadedChild(obj)
+		obj._refresh()
+		return obj
+
+	def _loadRow(self,row):
+		"""
+		  Sets the object's own attributes from its row of a saved page.  This
+		  should be overwritten by objects with attributes of their own.
+		"""
 		pass
 
+	def addLoadedChild(self,obj):
+		"""
+		  Adds a child made by fromRow, without anything being laid out,
+		  indexed or recorded.
+		"""
+		if len(self._children) == 0:
+			self._children = []
+		self._children.append(obj)
+
+	# Every staff keeps an index of the rectangles of all of its descendants,
+	# one per class (see Staff).  These keep it up to date as objects are
+	# added, removed and moved.
+	def _staff(self):
+		obj = self
+		while obj._parent:
+			obj = obj._parent
+		if obj.__class__ == Staff:
+			return obj
+		return None
+
+	def _indexTree(self,obj):
+		staff = self._staff()
+		if staff:
+			for descendant in obj._descendants():
+				staff._register(descendant)
+
+	def _unindexTree(self,obj):
+		staff = self._staff()
+		if staff:
+			for descendant in obj._descendants():
+				staff._unregister(descendant)
+
+	def _rectChanged(self):
+		"""
+		  This should be called whenever the object's rect is changed.
+		"""
+		staff = self._staff()
+		if staff and staff._isRegistered(self):
+			staff._register(self)
+
+	def _descendants(self):
+		descendants = [self]
+		for child in self._children:
+			descendants += child._descendants()
+		return descendants
+
+	def _treePosition(self):
+		"""
+		  A key that sorts objects in the order that the recursive methods
+		  visit them in (depth first, children in order), or None if the object
+		  is no longer in its staff's tree.
+		"""
+		# (Objects are unindexed when they are removed from a staff, so only
+		# the staff's descendants need to be checked)
+		if self._parent.__class__ == Staff:
+			return (self._parent.childOrder(self),)
+		if self not in self._parent._children:
+			return None
+		parentPosition = self._parent._treePosition()
+		if parentPosition is None:
+			return None
+		return parentPosition + (self._parent._children.index(self),)
+
 	def dist(self,point):
 		return 0
 
@@ -176,7 +362,8 @@ class MusicObject:
 
 		# Then, remove any children that should be removed.
 		for child in childrenToRemove:
-			self._children.remove(child)
+			self._removeChild(child)
+			self._unindexTree(child)
 			self._adoptFrom(child)
 
 		# Now, deal with self
@@ -217,25 +404,148 @@ class Staff(MusicObject):
 	  clefs, and various other musical symbols, and most other markings are
 	  descendents of a staff.
 	"""
-	def __init__(self,parent,width,yPos):
+	def __init__(self,parent,width,yPos,history=None):
+		# The index of every descendant's rect (one for each class, keyed by
+		# class), so that intersections can be found without visiting the
+		# whole tree, or objects of other classes
+		self._indexes = {}
+		# The positions and styles of the staff's notes (see NoteStore)
+		self._notes = NoteStore()
+		# Children are numbered in the order they are added (which is the
+		# order of self._children), by child
+		self._childOrders = weakref.WeakKeyDictionary()
+		self._childCount = 0
+		# The history that changes to the staff's tree are recorded in (see
+		# History), if any
+		self._history = history
 		MusicObject.__init__(self,parent)
 		self._yMiddle = yPos
 		self._width = width
 		height = STAFFSPACING*4.0
-		self._rect = pygame.Rect(0,yPos-height/2.0,width,height)
+		self._rect = Rect(0,yPos-height/2.0,width,height)
 
-	def draw(self,canvas,scale):
+	def addChild(self,obj):
+		# (The number is recorded, so that a child that was added again is
+		# put back in its earlier place if that is undone)
+		self._record(('order',self,obj,self._childOrders.get(obj),self._childCount))
+		self._childOrders[obj] = self._childCount
+		self._childCount += 1
+		MusicObject.addChild(self,obj)
+
+	def childOrder(self,obj):
 		"""
-		  Draw the staff and all its children (notes, barlines, clefs, etc.)
+		  Returns the number of children that were added to the staff before
+		  the given one, which orders the children as self._children does.
 		"""
-		# Draw staff
-		for i in [-2,-1,0,1,2]:
-			h = int((i*STAFFSPACING+self._yMiddle))
-			pygame.draw.line(canvas, BLACK, (0,h), (self._width,h), int(1.0))
+		return self._childOrders[obj]
 
-		# Draw children
-		for obj in self._children:
-			obj.draw(canvas,scale)
+	def applyChange(self,change,undo):
+		if change[0] != 'order':
+			MusicObject.applyChange(self,change,undo)
+		elif (change[3] if undo else change[4]) is None:
+			del self._childOrders[change[2]]
+		else:
+			self._childOrders[change[2]] = change[3] if undo else change[4]
+
+	def _register(self,obj):
+		"""
+		  Adds the object to the index for its class, or moves it there.
+		"""
+		if obj.__class__ not in self._indexes:
+			self._indexes[obj.__class__] = GridIndex(INDEXCELLSIZE)
+		self._indexes[obj.__class__].update(obj)
+		if obj.__class__ == Note:
+			obj._store.live[obj._slot] = True
+
+	def _unregister(self,obj):
+		index = self._indexes.get(obj.__class__)
+		if index is not None:
+			index.remove(obj)
+		if obj.__class__ == Note:
+			obj._store.live[obj._slot] = False
+
+	def _isRegistered(self,obj):
+		index = self._indexes.get(obj.__class__)
+		return index is not None and obj in index
+
+	def _indexesOf(self,type):
+		if type == TYPE_ANY:
+			return self._indexes.values()
+		if type in self._indexes:
+			return [self._indexes[type]]
+		return []
+
+	def getObjects(self,type=TYPE_ANY):
+		"""
+		  Returns every descendant of the given class (not including the
+		  staff itself), in tree order.
+		"""
+		objects = []
+		for index in self._indexesOf(type):
+			objects += index.objects()
+		return self._sortedInTree(objects)
+
+	def getNotesAt(self,point):
+		"""
+		  Returns the notes under the point, in tree order (the same notes as
+		  recurseGetIntersectPoint(point,Note), found all at once from the
+		  staff's NoteStore).
+		"""
+		return self._sortedInTree(self._notes.notesAt(point))
+
+	def exportNotes(self):
+		"""
+		  Returns the lines, positions, styles and stems of the staff's notes,
+		  as a dictionary of arrays (see NoteStore.export).
+		"""
+		# (This unregisters any notes that have been left out of the tree)
+		self.getObjects(Note)
+		return self._notes.export()
+
+	def getObjectsNear(self,rect):
+		"""
+		  Returns the descendants that might intersect the rectangle (every
+		  one that does, and perhaps some others nearby), in no particular
+		  order.
+		"""
+		found = set()
+		for index in self._indexes.values():
+			found.update(index.nearRect(rect))
+		return found
+
+	def _sortedInTree(self,objects):
+		"""
+		  Puts objects found with the index in tree order, dropping (and
+		  unindexing) any that have been left out of the tree, such as notes
+		  that a stem has replaced with another on the same line.
+		"""
+		positions = []
+		for obj in objects:
+			position = obj._treePosition()
+			if position is None:
+				self._unregister(obj)
+			else:
+				positions.append((position,obj))
+		positions.sort(key=lambda entry: entry[0])
+		return [obj for position, obj in positions]
+
+	def recurseGetIntersectPoint(self,point,type=TYPE_ANY):
+		intersectList = []
+		if (self.__class__ == type or type == TYPE_ANY) and self.intersectPoint(point):
+			intersectList.append(self)
+		found = []
+		for index in self._indexesOf(type):
+			found += [obj for obj in index.nearPoint(point) if obj.intersectPoint(point)]
+		return intersectList + self._sortedInTree(found)
+
+	def recurseGetIntersectRect(self,rect,type=TYPE_ANY):
+		intersectList = []
+		if (self.__class__ == type or type == TYPE_ANY) and self.intersectRect(rect):
+			intersectList.append(self)
+		found = []
+		for index in self._indexesOf(type):
+			found += [obj for obj in index.nearRect(rect) if obj.intersectRect(rect)]
+		return intersectList + self._sortedInTree(found)
 
 	def dist(self,point):
 		"""
@@ -243,13 +553,83 @@ class Staff(MusicObject):
 		"""
 		return abs(self._yMiddle-point[1])
 
+	def getChildrenAt(self,point):
+		"""
+		  Returns the children that have something (themselves or one of their
+		  descendants) under the point, in order.
+		"""
+		children = []
+		for obj in self.recurseGetIntersectPoint(point):
+			if obj is self:
+				continue
+			while obj._parent is not self:
+				obj = obj._parent
+			if obj not in children:
+				children.append(obj)
+		return children
+
+	def removeAt(self,point):
+		"""
+		  The same as MusicObject.removeAt, but only the children with
+		  something under the point (found with the index) are visited.
+		"""
+		removedChildren = False
+		childrenToRemove = []
+		for child in self.getChildrenAt(point):
+			remove, removedChild = child.removeAt(point)
+			removedChildren = removedChildren or removedChild or remove
+			if remove:
+				childrenToRemove.append(child)
+
+		for child in childrenToRemove:
+			self._removeChild(child)
+			self._unindexTree(child)
+			self._adoptFrom(child)
+
+		remove = self.intersectPoint(point)
+		if not remove and removedChildren:
+			self._reorg()
+		return remove, removedChildren
+
+	def restore(self,inTree):
+		# (The staff itself never changes, only its children)
+		pass
+
+	def loadChildren(self,classes,rows):
+		"""
+		  Adds the descendants of a saved staff (see Documents.py) to this one,
+		  which should be empty, all at once.  They are given in tree order
+		  (each after its parent), as their classes and rows, where the
+		  parent column is the index of the object's parent, or -1 for the
+		  staff's children.  The objects keep the layout they were saved
+		  with, and are indexed after they have all been added.
+		"""
+		loaded = []
+		# (Each row is read as a dictionary, which is quicker to look columns
+		# up in than a NumPy row)
+		names = rows.dtype.names
+		for cls, values in zip(classes,rows.tolist()):
+			row = dict(zip(names,values))
+			if row['parent'] < 0:
+				parent = self
+			else:
+				parent = loaded[row['parent']]
+			loaded.append(cls.fromRow(parent,row))
+		for obj in loaded:
+			self._register(obj)
+
+	def addLoadedChild(self,obj):
+		self._childOrders[obj] = self._childCount
+		self._childCount += 1
+		MusicObject.addLoadedChild(self,obj)
+
 	def _adoptFrom(self,oldParent):
 		if oldParent.__class__ == Stem:
 			for child in oldParent._children:
 				child.stemToStaff()
 
 	def removeChild(self,obj):
-		self._children.remove(obj)
+		self._removeChild(obj)
 
 	def whichLine(self,y):
 		"""
@@ -265,12 +645,13 @@ class Barline(MusicObject):
 		# For barlines, the horizontal position is all that matters
 		self._xPos = xPos;
 		self._style = BARLINE_NORMAL
-		self._rect = pygame.Rect(xPos-1,self._parent._rect.top,2,STAFFSPACING*4.0)
-	def draw(self,canvas,scale):
-		x = self._xPos
-		t = self._rect.top
-		b = self._rect.bottom
-		pygame.draw.line(canvas,pygame.Color("black"),(x,t),(x,b),2)
+		self._rect = Rect(xPos-1,self._parent._rect.top,2,STAFFSPACING*4.0)
+		self._rectChanged()
+
+	def _loadRow(self,row):
+		self._xPos = float(row['xPos'])
+		self._style = int(row['style'])
+		self._rect = Rect(self._xPos-1,self._parent._rect.top,2,STAFFSPACING*4.0)
 
 	def dist(self,point):
 		"""
@@ -279,16 +660,14 @@ class Barline(MusicObject):
 		return self._distVerticalLine(point)
 
 class Accent(MusicObject):
+	__slots__ = ('_style',)
+
 	def __init__(self,parent,style):
 		MusicObject.__init__(self,parent)
 		self._parent = parent
 		self._style = style
 		self._setRect()
 
-	def draw(self,canvas,scale):
-		if self._style == ACC_RHYTHM_DOT or self._style == ACC_STACCATO:
-			pygame.draw.circle(canvas,pygame.Color("black"),[int(round(self._rect.centerx)),int(round(self._rect.centery))], int(round(0.1*STAFFSPACING/2.0)))
-
 	def _setRect(self):
 		if self._style == ACC_RHYTHM_DOT:
 			self._rect = self._parent._rect.move(STAFFSPACING*1,0)
@@ -296,6 +675,7 @@ class Accent(MusicObject):
 		elif self._style == ACC_STACCATO:
 			self._rect = self._parent._rect.move(0,-STAFFSPACING*1)
 			self._rect.inflate_ip(-self._rect.w*0.9,-self._rect.h*0.9)
+		self._rectChanged()
 
 	def move(self):
 		"""
@@ -304,37 +684,26 @@ class Accent(MusicObject):
 		"""
 		self._setRect()
 
+	def _refresh(self):
+		self._setRect()
+
+	def _loadRow(self,row):
+		self._style = int(row['style'])
+
 class Accidental(MusicObject):
 	"""
 	  The accidental object is a sharp/flat/natural (or perhaps someday double,
 	  three quarters, etc.), and should be the child of a note.  It has no
 	  position, except that defined by its parent.
 	"""
+	__slots__ = ('_style',)
+
 	def __init__(self,parent,style):
 		MusicObject.__init__(self,parent)
 		self._parent = parent
 		self._style = style
 		self._setRect()
 
-	def draw(self,canvas,scale):
-		if self._style == ACC_SHARP:
-			# Vertical lines
-			pygame.draw.line(canvas,pygame.Color("black"),(self._rect.left+self._rect.w*0.33,self._rect.top),(self._rect.left+self._rect.w*0.33,self._rect.bottom),2)
-			pygame.draw.line(canvas,pygame.Color("black"),(self._rect.left+self._rect.w*0.66,self._rect.top),(self._rect.left+self._rect.w*0.66,self._rect.bottom),2)
-			# Horizontal lines
-			pygame.draw.line(canvas,pygame.Color("black"),(self._rect.left,self._rect.h*0.40+self._rect.top),(self._rect.right,self._rect.w*0.26+self._rect.top),2)
-			pygame.draw.line(canvas,pygame.Color("black"),(self._rect.left,self._rect.h*0.73+self._rect.top),(self._rect.right,self._rect.w*0.59+self._rect.top),2)
-		elif self._style == ACC_FLAT:
-			pygame.draw.line(canvas,pygame.Color("black"),(self._rect.left,self._rect.top),(self._rect.left,self._rect.bottom),2)
-			pygame.draw.arc(canvas,pygame.Color("black"),pygame.Rect(self._rect.left-self._rect.w,self._rect.top+self._rect.h*0.34,self._rect.w*2.0,self._rect.h*0.68),-pi/2,0,2)
-			pygame.draw.arc(canvas,pygame.Color("black"),pygame.Rect(self._rect.left-self._rect.w/3.0,self._rect.top+self._rect.h*0.5,self._rect.w*4.0/3.0,self._rect.h*0.34),0,pi/2,2)
-			pygame.draw.line(canvas,pygame.Color("black"),(self._rect.left,self._rect.top+self._rect.h*0.67),(self._rect.left+self._rect.w/3.0,self._rect.top+self._rect.h/2.0),2)
-		elif self._style == ACC_NATURAL:
-			pygame.draw.line(canvas,pygame.Color("black"),(self._rect.left,self._rect.top),(self._rect.left,self._rect.top+self._rect.h*0.7),1)
-			pygame.draw.line(canvas,pygame.Color("black"),(self._rect.right,self._rect.top+self._rect.h*0.3),(self._rect.right,self._rect.bottom),1)
-			pygame.draw.line(canvas,pygame.Color("black"),(self._rect.left,self._rect.top+self._rect.h*0.4),(self._rect.right,self._rect.top+self._rect.h*0.2),3)
-			pygame.draw.line(canvas,pygame.Color("black"),(self._rect.left,self._rect.top+self._rect.h*0.8),(self._rect.right,self._rect.top+self._rect.h*0.6),3)
-
 	def _setRect(self):
 		if self._style == ACC_SHARP:
 			self._rect = self._parent._rect.move(-STAFFSPACING*1.3,0)
@@ -344,6 +713,7 @@ class Accidental(MusicObject):
 		elif self._style == ACC_NATURAL:
 			self._rect = self._parent._rect.move(-STAFFSPACING*1.1,0)
 			self._rect.inflate_ip(-self._rect.w*0.6,self._rect.h)
+		self._rectChanged()
 
 	def move(self):
 		"""
@@ -352,6 +722,91 @@ class Accidental(MusicObject):
 		"""
 		self._setRect()
 
+	def _refresh(self):
+		self._setRect()
+
+	def _loadRow(self,row):
+		self._style = int(row['style'])
+
+class NoteStore(object):
+	"""
+	  The positions and styles of a staff's notes, in NumPy arrays (one per
+	  attribute, with a row per note), so that they take little memory, and
+	  can be searched and exported all at once.  The Note objects read and
+	  write their rows through properties.
+
+	  A row is in use until its note is garbage collected, so that removed
+	  notes keep their positions (in case they are put back), but only the
+	  notes in the staff's tree are marked as live.
+	"""
+	# The attributes stored for each note, and their types
+	COLUMNS = [('line',int32),('xPos',float64),('style',int8),('x',float64),('y',float64),
+	           ('stem',int32),('live',bool_)]
+
+	def __init__(self,capacity=16):
+		for name, dtype in self.COLUMNS:
+			setattr(self,name,zeros(capacity,dtype))
+		self._notes = [None]*capacity
+		self._free = range(capacity-1,-1,-1)
+		self._stemCount = 0
+
+	def __len__(self):
+		return len(self._notes)-len(self._free)
+
+	def add(self,note):
+		"""
+		  Returns the row for a new note.
+		"""
+		if len(self._free) == 0:
+			capacity = len(self._notes)
+			for name, dtype in self.COLUMNS:
+				setattr(self,name,concatenate((getattr(self,name),zeros(capacity,dtype))))
+			self._notes += [None]*capacity
+			self._free = range(2*capacity-1,capacity-1,-1)
+		slot = self._free.pop()
+		for name, dtype in self.COLUMNS:
+			getattr(self,name)[slot] = 0
+		self.stem[slot] = -1
+		self._notes[slot] = weakref.ref(note,lambda ref, slot=slot: self._release(slot))
+		return slot
+
+	def _release(self,slot):
+		self.live[slot] = False
+		self._notes[slot] = None
+		self._free.append(slot)
+
+	def newStemId(self):
+		"""
+		  Returns a number for a new stem on the staff (see the stem column).
+		"""
+		self._stemCount += 1
+		return self._stemCount-1
+
+	def notesAt(self,point):
+		"""
+		  Returns the live notes under the point (in no particular order).
+		"""
+		dx = self.x-point[0]
+		dy = self.y-point[1]
+		slots = flatnonzero(self.live & (sqrt(dx*dx+dy*dy) <= STAFFSPACING/2.0))
+		return [self._notes[slot]() for slot in slots]
+
+	def export(self):
+		"""
+		  Returns a copy of the columns of the live notes, as a dictionary of
+		  arrays (the stem column holds the stem's number, or -1 for free
+		  notes).
+		"""
+		slots = flatnonzero(self.live)
+		return dict((name,getattr(self,name)[slots]) for name, dtype in self.COLUMNS if name != 'live')
+
+def _noteColumn(name,convert):
+	def get(note):
+		return convert(getattr(note._store,name)[note._slot])
+	def set(note,value):
+		getattr(note._store,name)[note._slot] = value
+	return property(get,set)
+
 class Note(MusicObject):
 	"""
 	  The notehead object represents a single notehead.  It's parent is either a
@@ -367,9 +822,25 @@ class Note(MusicObject):
 	
 	  In either case, the y position is the line or space number of the staff
 	  that is either its parent or grandparent.
+
+	  The note's attributes (besides those of every music object) are kept in
+	  its staff's NoteStore.
 	"""
+	__slots__ = ('_store','_slot')
+
+	_line = _noteColumn('line',int)
+	_xPos = _noteColumn('xPos',float)
+	_style = _noteColumn('style',int)
+	_x = _noteColumn('x',float)
+	_y = _noteColumn('y',float)
 
 	def __init__(self,parent,pos,style):
+		staff = parent._staff()
+		if staff:
+			self._store = staff._notes
+		else:
+			self._store = NoteStore(1)
+		self._slot = self._store.add(self)
 		MusicObject.__init__(self,parent)
 		self._style = style
 		self._parent = parent
@@ -380,30 +851,6 @@ class Note(MusicObject):
 		self._xPos = pos[0] # Absolute pos for free, side of stem for stemmed
 		self._setRectAndPos()
 
-	def draw(self,canvas,scale):
-		if self._parent.__class__ == Staff:
-			staffMiddle = self._parent._yMiddle
-		elif self._parent.__class__ == Stem:
-			staffMiddle = self._parent._parent._yMiddle
-
-		if self._style == NOTE_FILLED:
-			pygame.draw.circle(canvas,pygame.Color("black"),[int(round(self._x)),int(round(self._y))], int(round(STAFFSPACING/2.0)))
-		elif self._style == NOTE_EMPTY:
-			pygame.draw.circle(canvas,pygame.Color("black"),[int(round(self._x)),int(round(self._y))], int(round(STAFFSPACING/2.0)), 2)
-
-		# Draw ledger lines if the note is...
-		# ...above the staff, or...
-		for line in range(int(ceil(self._line/2.))*2,-4,2):
-			h = int((staffMiddle+(line/2)*STAFFSPACING)*scale)
-			pygame.draw.line(canvas, BLACK, (self._x-(STAFFSPACING/1.5)*scale,h), (self._x+(STAFFSPACING/1.5),h), int(1.0))
-		# below the staff
-		for line in range(6,int(self._line/2)*2+2,2):
-			h = int((staffMiddle+(line/2)*STAFFSPACING)*scale)
-			pygame.draw.line(canvas, BLACK, (self._x-(STAFFSPACING/1.5)*scale,h), (self._x+(STAFFSPACING/1.5),h), int(1.0))
-
-		for child in self._children:
-			child.draw(canvas,scale)
-
 	def dist(self,point):
 		"""
 		  The distance function here will return the distance, in page
@@ -428,31 +875,48 @@ class Note(MusicObject):
 		elif self._parent.__class__ == Stem:
 			self._x = self._parent._xPos + (STAFFSPACING/2.0)*self._xPos
 			self._y = self._parent._parent._yMiddle + (STAFFSPACING/2.0)*self._line
-		self._rect = pygame.Rect(self._x-STAFFSPACING/2.0,self._y-STAFFSPACING/2.0,STAFFSPACING,STAFFSPACING)
+		self._rect = Rect(self._x-STAFFSPACING/2.0,self._y-STAFFSPACING/2.0,STAFFSPACING,STAFFSPACING)
+		self._rectChanged()
 
 		for child in self._children:
 			child.move()
 
+	def _refresh(self):
+		if self._parent.__class__ == Stem:
+			self._store.stem[self._slot] = self._parent._stemId
+		else:
+			self._store.stem[self._slot] = -1
+		self._setRectAndPos()
+
+	def _loadRow(self,row):
+		self._store = self._staff()._notes
+		self._slot = self._store.add(self)
+		self._line = row['line']
+		self._xPos = row['xPos']
+		self._style = row['style']
+
 	def staffToStem(self,stem):
 		"""
 		  NOTE: called by stem only
 		"""
 		# reset x-position
-		self._xPos = -stem.isStemUp()
+		self._set('_xPos',-stem.isStemUp())
 
 		# change ownership (already owned by stem who called this)
 		self._parent.removeChild(self)
-		self._parent = stem
+		self._set('_parent',stem)
+		self._store.stem[self._slot] = stem._stemId
 
 		# Adjust rectangle and position
 		self._setRectAndPos()
 
 	def stemToStaff(self):
 		# reset x-position (absolute instead of side)
-		self._xPos = self._parent._xPos + (STAFFSPACING/2.0)*self._xPos;
+		self._set('_xPos',self._parent._xPos + (STAFFSPACING/2.0)*self._xPos)
 
 		# change ownership (owned by no-one)
-		self._parent = self._parent._parent
+		self._set('_parent',self._parent._parent)
+		self._store.stem[self._slot] = -1
 		self._parent.addChild(self)
 
 		# Adjust rectangle and position
@@ -463,7 +927,7 @@ class Note(MusicObject):
 		  If the note's parent is a stem, set which side of the stem it is on.
 		  This method should not be called if the parent is not a stem.
 		"""
-		self._xPos = side
+		self._set('_xPos',side)
 
 		# Adjust rectangle and position
 		self._setRectAndPos()
@@ -490,6 +954,12 @@ class Stem(MusicObject):
 		self._children = children
 		# The parent staff which this stem belongs to.
 		self._parent = parent
+		# The stem's number on the staff (see NoteStore)
+		staff = self._staff()
+		if staff:
+			self._stemId = staff._notes.newStemId()
+		else:
+			self._stemId = -1
 		self._xPos = pos[0]
 		self._baseLine = pos[1]
 
@@ -500,14 +970,6 @@ class Stem(MusicObject):
 		self._setRect()
 		self._clusterNotes()
 
-	def draw(self,canvas,scale):
-		for note in self._children:
-			note.draw(canvas,scale)
-		x = self._xPos
-		t = self._rect.top
-		b = self._rect.bottom
-		pygame.draw.line(canvas,pygame.Color("black"),(x,t),(x,b),2)
-
 	def dist(self,point):
 		"""
 		  The distance function here will return the distance, in page
@@ -523,34 +985,47 @@ class Stem(MusicObject):
 			yTop -= self._length*STAFFSPACING/2.0
 		else:
 			yBot += self._length*STAFFSPACING/2.0
-		self._rect = pygame.Rect(x-1,yTop,2,yBot-yTop)
+		self._rect = Rect(x-1,yTop,2,yBot-yTop)
+		self._rectChanged()
+
+	def _refresh(self):
+		self._setRect()
+
+	def _loadRow(self,row):
+		self._direction = int(row['direction'])
+		self._length = int(row['length'])
+		self._xPos = float(row['xPos'])
+		self._baseLine = int(row['line'])
+		self._stemId = self._staff()._notes.newStemId()
 
 	def _reorg(self):
-		self._orderNotes()
+		# (Removing notes leaves the rest in order)
 
 		# the base note is the lowest on the page (highest y)
 		if self._direction == 1:
 			maxPos = self._children[-1]._line
-			self._length -= self._baseLine-maxPos
-			self._baseLine = maxPos
+			self._set('_length',self._length-(self._baseLine-maxPos))
+			self._set('_baseLine',maxPos)
 		# the base note is the highest on the page (lowest y)
 		else:
 			minPos = self._children[0]._line
-			self._length -= minPos-self._baseLine
-			self._baseLine = minPos
+			self._set('_length',self._length-(minPos-self._baseLine))
+			self._set('_baseLine',minPos)
 
 		# prevent the stem from becoming super-short
-		self._length = max(self._length,MINSTEMLENGTH)
+		self._set('_length',max(self._length,MINSTEMLENGTH))
 		self._setRect()
 		self._clusterNotes()
 
 	def addNotes(self,children):
 		for note in children:
-			self._children.append(note)
+			# (Notes already on the stem are found again when a chord is drawn)
+			if note._parent is self:
+				continue
+			i = self._insertionIndex(note._line)
+			self._insertChild(i,note)
 			note.staffToStem(self)
-
-		self._orderNotes()
-		self._clusterNotes()
+			self._clusterNotes(i)
 
 	# TODO: move to bottom and top line rather than base and length?
 
@@ -558,40 +1033,56 @@ class Stem(MusicObject):
 		"""
 		  Whenever the stem references self._children, it assumes that it is
 		  in order, from lowest to highest line.  This function ensures that
-		  that is the case.
+		  that is the case (notes on the same line are kept in the order they
+		  were added).
 		"""
-		# Build "Order" to contain the sorted order of references into noteDict
-		noteDict = {}
-		for note in self._children:
-			noteDict[note._line] = note
-		order = noteDict.keys()
-		order.sort()
+		self._children.sort(key=lambda note: note._line)
 
-		# Rebuild the list with the correct note ordering
-		self._children = [noteDict[index] for index in order]
-
-	def _clusterNotes(self):
+	def _insertionIndex(self,line):
+		"""
+		  Returns where a note on the given line goes in self._children (after
+		  any notes already on that line), with a binary search.
+		"""
+		low, high = 0, len(self._children)
+		while low < high:
+			middle = (low+high)//2
+			if line < self._children[middle]._line:
+				high = middle
+			else:
+				low = middle+1
+		return low
+
+	def _clusterNotes(self,changed=None):
 		"""
 			This function computes the correct x-position (left or right of the
 			stem) for each note in a chord, taking into account the effect of
-			"clustered" notes (ones a second apart)
-		"""
-		# For a down-stem:
-		if self._direction == -1:
-			self._children[0].setSide(-self._direction)
-			for i in range(1,len(self._children)):
-				if (self._children[i-1]._line == self._children[i]._line-1):
-					self._children[i].setSide(-self._children[i-1]._xPos)
-				else:
-					self._children[i].setSide(-self._direction)
-		# For an up-stem:
+			"clustered" notes (ones a second apart, or on the same line)
+
+			Notes are laid out from the base of the stem: the base note is on
+			the usual side, and each note after it is on the usual side too,
+			unless it is clustered with the one before it, in which case it is
+			on the other side from that one.  If only the note at index changed
+			has been added, only the notes from it up to the first one that is
+			already on the right side are moved.
+		"""
+		notes = self._children
+		# For a down-stem, the base is the first note; for an up-stem, the last
+		step = -self._direction
+		if changed is None:
+			i = 0 if step == 1 else len(notes)-1
 		else:
-			self._children[-1].setSide(-self._direction)
-			for i in range(1,len(self._children)):
-				if (self._children[-i]._line == self._children[-i-1]._line+1):
-					self._children[-i-1].setSide(-self._children[-i]._xPos)
-				else:
-					self._children[-i-1].setSide(-self._direction)
+			i = changed
+		while 0 <= i < len(notes):
+			previous = i-step
+			if 0 <= previous < len(notes) and abs(notes[i]._line-notes[previous]._line) <= 1:
+				side = -notes[previous]._xPos
+			else:
+				side = -self._direction
+			if notes[i]._xPos != side:
+				notes[i].setSide(side)
+			elif changed is not None and i != changed:
+				break
+			i += step
 
 	def isStemUp(self):
 		return self._direction
@@ -0,0 +1,210 @@
+# This file finds the training samples nearest to a shape, so that shapes can
+# be classified by the symbols of their nearest neighbours (see
+# Symbols.classify) rather than by the templates' summary statistics.
+#
+# Every sample in the sample log is kept in an index, as a short vector: its
+# features are normalized (so that each feature counts equally, however many
+# values it has), and reduced to their principal components.  A search
+# compares the shape to every sample in the index with one matrix multiply,
+# and then compares the closest candidates in full, reading them back from the
+# (memory-mapped) log.  The index holds at most MAXPERSYMBOL samples of each
+# symbol (the most recent ones), so the time a search takes stays bounded
+# however long the training history grows.
+
+import os
+import numpy as np
+from time import time
+
+import Templates
+
+# TODO: put this into config file
+# The features that samples are compared by (every sample has these; older
+# samples have no density grid)
+FEATURES = ['xproj','yproj','size']
+# Number of principal components that the index keeps of each sample
+DIMENSIONS = 32
+# Number of candidates found with the index that are then compared in full
+CANDIDATES = 64
+# Maximum number of samples of each symbol in the index (the most recent)
+MAXPERSYMBOL = 20000
+# Samples are indexed, and searched, this many at a time, to bound the memory
+# used along the way
+CHUNKSIZE = 65536
+# The index is rebuilt (rather than extended) once the log has grown by this
+# fraction since it was built
+REBUILDFRACTION = 0.1
+# Minimum number of seconds between checks for a modified sample log
+CHECKINTERVAL = 1.0
+
+def _rawFeatures(samples):
+	"""
+	  The features of samples (a record array of the sample log, or a
+	  dictionary of N x feature size arrays) side by side, as an N x F array.
+	"""
+	return np.hstack([np.asarray(samples[feature],float).reshape([len(samples[feature]),-1]) for feature in FEATURES])
+
+def _recentRows(symbols):
+	"""
+	  Returns the rows (in order) of the last MAXPERSYMBOL samples of each
+	  symbol.
+	"""
+	keep = np.zeros(len(symbols),bool)
+	for symbol in np.unique(symbols):
+		rows = np.flatnonzero(symbols == symbol)
+		keep[rows[-MAXPERSYMBOL:]] = True
+	return np.flatnonzero(keep)
+
+class SampleIndex:
+	"""
+	  The index of the samples in a sample log.  Like the template bank, it is
+	  only rebuilt when the log changes: samples appended to the log are added
+	  to the index as they are (with the normalization and components that it
+	  was built with), and it is only rebuilt when the log is rewritten, or
+	  has grown by REBUILDFRACTION.
+	"""
+	def __init__(self,path):
+		self.path = path
+		self.symbols = np.zeros(0,'S16')
+		# Counts the times samples have been added to the index
+		self.version = 0
+		self._stat = None
+		self._lastCheck = -np.inf
+
+	def __len__(self):
+		return len(self.symbols)
+
+	def build(self):
+		"""
+		  (Re)build the index from every sample in the log.
+		"""
+		stat = os.stat(self.path)
+		samples = Templates.readSamples(self.path)
+		rows = _recentRows(samples['symbol'])
+
+		# Normalize each value to zero mean and unit variance, and then each
+		# feature to unit variance overall
+		sizes = dict(Templates.FEATURES)
+		weights = np.hstack([np.ones(sizes[feature])/np.sqrt(sizes[feature]) for feature in FEATURES])
+		total = 0
+		sums = np.zeros(len(weights))
+		squares = np.zeros(len(weights))
+		for first in range(0,len(rows),CHUNKSIZE):
+			features = _rawFeatures(samples[rows[first:first+CHUNKSIZE]])
+			total += len(features)
+			sums = sums + np.sum(features,0)
+			squares = squares + np.sum(np.square(features),0)
+		self._mean = sums/max(total,1)
+		std = np.sqrt(np.maximum(squares/max(total,1)-np.square(self._mean),0))
+		std[std == 0] = 1
+		self._scale = weights/std
+
+		# The principal components are the eigenvectors of the covariance of
+		# the normalized features with the largest eigenvalues
+		covariance = np.zeros([len(weights),len(weights)])
+		for first in range(0,len(rows),CHUNKSIZE):
+			normalized = self._normalize(_rawFeatures(samples[rows[first:first+CHUNKSIZE]]))
+			covariance = covariance + np.dot(normalized.T,normalized)
+		eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+		self._components = eigenvectors[:,::-1][:,:DIMENSIONS]
+
+		self._samples = samples
+		self._rows = np.zeros(0,int)
+		self._reduced = np.zeros([0,np.size(self._components,1)],np.float32)
+		self._norms = np.zeros(0,np.float32)
+		self.symbols = np.zeros(0,'S16')
+		self._add(rows)
+
+		self._builtCount = len(samples)
+		self._stat = stat
+		self._lastCheck = time()
+
+	def _normalize(self,features):
+		return (features-self._mean)*self._scale
+
+	def _add(self,rows):
+		"""
+		  Adds rows of the sample log to the index.
+		"""
+		reduced = [self._reduced]
+		for first in range(0,len(rows),CHUNKSIZE):
+			normalized = self._normalize(_rawFeatures(self._samples[rows[first:first+CHUNKSIZE]]))
+			reduced.append(np.dot(normalized,self._components).astype(np.float32))
+		self._reduced = np.concatenate(reduced)
+		self._norms = np.sum(np.square(self._reduced),1)
+		self._rows = np.concatenate((self._rows,rows))
+		self.symbols = np.concatenate((self.symbols,self._samples['symbol'][rows]))
+		self.version += 1
+
+	def _extend(self,stat):
+		"""
+		  Adds the samples that have been appended to the log since it was last
+		  read to the index.
+		"""
+		samples = Templates.readSamples(self.path)
+		first = len(self._samples)
+		self._samples = samples
+		self._add(np.arange(first,len(samples)))
+		self._stat = stat
+
+	def refresh(self):
+		"""
+		  Force the index to be rebuilt the next time it is used.
+		"""
+		self._stat = None
+
+	def current(self):
+		"""
+		  Returns the index, making sure that it includes every sample in the
+		  log.
+		"""
+		if self._stat is None:
+			self.build()
+		elif time()-self._lastCheck > CHECKINTERVAL:
+			self._lastCheck = time()
+			stat = os.stat(self.path)
+			if stat.st_ino != self._stat.st_ino or stat.st_size < self._stat.st_size:
+				# The log was rewritten
+				self.build()
+			elif stat.st_size != self._stat.st_size:
+				count = len(Templates.readSamples(self.path))
+				if count > self._builtCount*(1+REBUILDFRACTION):
+					self.build()
+				else:
+					self._extend(stat)
+		return self
+
+	def nearest(self,features,k):
+		"""
+		  Finds the k samples nearest to each of N shapes, whose features are
+		  given as a dictionary of N x feature size arrays (keyed by the names
+		  in FEATURES).  Returns the N x k distances (in normalized feature
+		  units, nearest first) and the indices of the samples in the index
+		  (see symbols), or fewer than k of each if the index is smaller.
+		"""
+		normalized = self._normalize(_rawFeatures(features))
+		k = min(k,len(self))
+		candidates = min(max(k,CANDIDATES),len(self))
+		distances = np.zeros([len(normalized),k])
+		indices = np.zeros([len(normalized),k],int)
+		if k == 0:
+			return distances, indices
+
+		# Search the index a few shapes at a time, so that the matrix of
+		# distances stays under CHUNKSIZE*CANDIDATES values
+		step = max(1,CHUNKSIZE*CANDIDATES//len(self))
+		for first in range(0,len(normalized),step):
+			queries = normalized[first:first+step]
+			reduced = np.dot(queries,self._components).astype(np.float32)
+			# Squared distances, as |a|^2 - 2a.b + |b|^2 (less |a|^2, which is
+			# the same for every sample)
+			squared = self._norms[np.newaxis,:] - 2*np.dot(reduced,self._reduced.T)
+			closest = np.argpartition(squared,candidates-1,1)[:,:candidates]
+
+			# Compare the candidates in full
+			for i in range(len(queries)):
+				full = self._normalize(_rawFeatures(self._samples[self._rows[closest[i]]]))
+				exact = np.sqrt(np.sum(np.square(full-queries[i]),1))
+				order = np.argsort(exact,kind='mergesort')[:k]
+				distances[first+i] = exact[order]
+				indices[first+i] = closest[i][order]
+		return distances, indices
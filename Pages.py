@@ -0,0 +1,354 @@
+"""
+This file contains the page, which holds the staves that music is written on,
+and decides what recognized symbols mean musically.  It does not depend on
+pygame: whatever the page is part of (see StaffPad in staffpad.py) is told
+when objects need to be drawn, so pages can also be used without a display
+(see HeadlessPad).
+"""
+
+import math
+import bisect
+import MusicObjects as mus
+from Geometry import Rect
+from History import History
+
+# TODO: put these into config file
+# Distance (in page coordinates) between the points along the eraser's path
+# that are checked for objects
+ERASERSTEP = 0.5
+# How far around changed objects is redrawn (to cover ledger lines, line
+# widths, etc. that are drawn outside of the objects' rects)
+DAMAGEMARGIN = mus.STAFFSPACING
+
+# This serves as a lookup dictionary to improve the readability of the addObject
+# code.
+typeLookup = {'dot':mus.NOTE_FILLED,'circle':mus.NOTE_EMPTY,'sharp':mus.ACC_SHARP,'natural':mus.ACC_NATURAL,'flat':mus.ACC_FLAT}
+
+class HeadlessPad:
+	"""
+	  Stands in for the StaffPad when pages are used without a display (for
+	  example, by recognition workers).  It has a page size, but nothing is
+	  ever drawn.
+	"""
+	def __init__(self,width=512,height=512):
+		self.pageSize = [width,height]
+
+	def redraw(self):
+		pass
+
+	def drawObject(self,obj):
+		pass
+
+	def damage(self,rect):
+		pass
+
+class Page:
+	def __init__(self,pad,empty=False):
+		"""
+		  This is a "page" of staff paper.  It has staves, which can contain
+		  notes and other symbols.
+		
+		  It shares common attributes, such as page size, with all the other
+		  pages in the pad.  Pages start with four staves, unless they are
+		  empty (such as pages that are being loaded, see Documents.py).
+		"""
+		self.pad = pad
+
+		# The changes made to the page's staves, so that they can be undone
+		self.history = History()
+
+		# A list of the staves on the page
+		# TODO: Eventually, these will probably become systems instead
+		self.staves = []
+		# The staves again, sorted by their vertical position, so that the
+		# closest one to a point can be found with a binary search.  Each is
+		# kept with its key, (middle y, number of staves added before it),
+		# and the key is also kept by staff, for when it is moved or removed.
+		self._staffKeys = []
+		self._sortedStaves = []
+		self._keysByStaff = {}
+		self._stavesAdded = 0
+
+		# Initialize the page with four staves
+		if not empty:
+			for i in range(4):
+				self.addStaff(100*i+110)
+
+	def addStaff(self,yPos,width=None):
+		if width is None:
+			width = self.pad.pageSize[0]
+		staff = mus.Staff(None,width,yPos,self.history)
+		self.staves.append(staff)
+		self._sortStaff(staff,self._stavesAdded)
+		self._stavesAdded += 1
+		return staff
+
+	def removeStaff(self,staff):
+		self.staves.remove(staff)
+		self._unsortStaff(staff)
+
+	def staffMoved(self,staff):
+		"""
+		  This should be called whenever a staff's position is changed.
+		"""
+		order = self._unsortStaff(staff)
+		self._sortStaff(staff,order)
+
+	def _sortStaff(self,staff,order):
+		key = (staff._yMiddle,order)
+		self._keysByStaff[staff] = key
+		i = bisect.bisect(self._staffKeys,key)
+		self._staffKeys.insert(i,key)
+		self._sortedStaves.insert(i,staff)
+
+	def _unsortStaff(self,staff):
+		"""
+		  Takes a staff out of the sorted staves, and returns the number of
+		  staves that were added before it.
+		"""
+		key = self._keysByStaff.pop(staff)
+		i = bisect.bisect_left(self._staffKeys,key)
+		del self._staffKeys[i]
+		del self._sortedStaves[i]
+		return key[1]
+
+	def getClosestStaff(self,point):
+		"""
+		  Returns the closest staff to the point, and its distance, like
+		  mus.getClosestStaff (when two staves are as close, the one added
+		  first), but only looks at the staves just above and below it.
+		"""
+		# The first staff at or below the point, and the first staff at the
+		# height of the closest staff above it
+		i = bisect.bisect_left(self._staffKeys,(point[1],))
+		candidates = self._sortedStaves[i:i+1]
+		if i > 0:
+			above = bisect.bisect_left(self._staffKeys,(self._staffKeys[i-1][0],))
+			candidates.append(self._sortedStaves[above])
+
+		best = None
+		dist = mus.inf
+		for staff in candidates:
+			staffDist = staff.dist(point)
+			if staffDist < dist or (staffDist == dist and self._keysByStaff[staff][1] < self._keysByStaff[best][1]):
+				dist = staffDist
+				best = staff
+		return best, dist
+
+	def removeObjectAtPoint(self,point):
+		"""
+		  This function removes any object that is underneath the given point.
+		"""
+		self.eraseSegment(point,point)
+
+	def undo(self):
+		"""
+		  Undoes the last change to the page (the last object added, or
+		  eraser stroke), redrawing only what it changed.
+		"""
+		self._damage(self.history.undo())
+
+	def redo(self):
+		self._damage(self.history.redo())
+
+	def _damage(self,changed):
+		"""
+		  Redraws the area around the rects that have changed, given as a list
+		  of (staff, rect).
+		"""
+		damaged = None
+		for staff, rect in changed:
+			damaged = damaged.union(rect) if damaged is not None else rect
+			# Notes above and below the staff have ledger lines to it
+			damaged = damaged.union(Rect(damaged.left,staff._rect.top,damaged.w,staff._rect.h))
+
+		if damaged is not None:
+			damaged = damaged.copy()
+			damaged.inflate_ip(2*DAMAGEMARGIN,2*DAMAGEMARGIN)
+			self.pad.damage(damaged)
+
+	def eraseSegment(self,start,end):
+		"""
+		  Removes any object underneath the line segment from start to end
+		  (the path of the eraser since the last frame).  Only the objects
+		  near the segment are checked, the staff's tree is only changed where
+		  something is hit, and only the area around the objects that were
+		  removed or moved is redrawn.  Everything erased is undone together.
+		"""
+		steps = int(math.ceil(math.hypot(end[0]-start[0],end[1]-start[1])/ERASERSTEP))
+		points = [(start[0]+(end[0]-start[0])*i/float(max(steps,1)),
+		           start[1]+(end[1]-start[1])*i/float(max(steps,1))) for i in range(steps+1)]
+		left, right = min(start[0],end[0]), max(start[0],end[0])
+		top, bottom = min(start[1],end[1]), max(start[1],end[1])
+		area = Rect(left,top,int(right)-int(left)+1,int(bottom)-int(top)+1)
+
+		changed = []
+		self.history.begin()
+		try:
+			for staff in self.staves:
+				if len(staff.getObjectsNear(area)) == 0:
+					continue
+				for point in points:
+					# Removing an object can move the rest of the staff's child
+					# it belongs to (a stem is shortened, notes change sides, or
+					# are left without a stem), so all of that is redrawn.
+					objects = [obj for child in staff.getChildrenAt(point) for obj in child._descendants()]
+					if len(objects) == 0:
+						continue
+					changed += [(staff,obj._rect) for obj in objects]
+					staff.removeAt(point)
+					changed += [(staff,obj._rect) for obj in objects]
+		finally:
+			self.history.end()
+
+		self._damage(changed)
+
+	def getObjects(self,type=mus.TYPE_ANY):
+		"""
+		  Returns every object of the given class on the page, staff by staff
+		  (from each staff's registry of its objects, so nothing else is
+		  visited).
+		"""
+		objects = []
+		for staff in self.staves:
+			objects += staff.getObjects(type)
+		return objects
+
+	def addObject(self,type,rect):
+		"""
+		  Adds whatever the shape of the given type (classified by Symbols)
+		  in the given rect means, as one change in the page's history.
+		"""
+		self.history.begin()
+		try:
+			self._addObject(type,rect)
+		finally:
+			self.history.end()
+
+	def _addObject(self,type,rect):
+		"""
+		  This function attempts to contain all of the logic for determining
+		  what a given shape (line, circle, etc) actually means musically.
+		  This is probably too much for one function, and should eventually be
+		  broken up into smaller chunks in some intelligent way.
+		"""
+		rect = Rect(rect[0][0],rect[0][1],rect[1][0]-rect[0][0],rect[1][1]-rect[0][1])
+
+		# Conditions to become a note:
+		# - symbol must be a circle or a dot
+		if type == 'circle' or type == 'dot':
+			# get closest staff to attach note to
+			staff, dist = self.getClosestStaff(rect.center)
+
+			# make note object
+			n = mus.Note(staff,rect.center,typeLookup[type])
+
+			# If there is a stem close, attach note to it
+			# TODO: do this before staff logic (modify MusicObject stem code
+			# to allow this)
+			# TODO: pick other than first? pick closest instead?
+			closeStems = staff.recurseGetIntersectRect(n._rect,mus.Stem)
+			if len(closeStems) != 0:
+				closeStems[0].addNotes([n])
+
+			# Redraw (necessary because note may affect other clustered notes)
+			self.pad.redraw()
+
+		elif type == 'sharp' or type == 'flat' or type == 'natural':
+			centerOffset = (rect.centerx+mus.STAFFSPACING*1.5,rect.centery)
+
+			# get closest staff on which to attach accidental to note
+			staff, dist = self.getClosestStaff(centerOffset)
+
+			r = mus.STAFFSPACING*0.25
+			area = Rect(centerOffset[0]-r,centerOffset[1]-r,2.0*r,2.0*r)
+			closeNotes = staff.recurseGetIntersectRect(area,mus.Note)
+			# TODO: Should there instead be a recurseGetClosest?
+
+			if len(closeNotes) > 0:
+				a = mus.Accidental(closeNotes[0],typeLookup[type])
+				self.pad.drawObject(a)
+			else:
+				print "nowhere to put " + type
+		elif type == 'sm_dot':
+			centerOffsetR = (rect.centerx-mus.STAFFSPACING*1.0,rect.centery) # In this case, it is a rhythm dot
+			centerOffsetS = (rect.centerx,rect.centery+mus.STAFFSPACING*1.0) # In this case, it is a staccato marking
+
+			# get closest staff on which to attach accidental to note
+			staff, dist = self.getClosestStaff(centerOffsetR)
+
+			r = mus.STAFFSPACING*0.25
+			area = Rect(centerOffsetR[0]-r,centerOffsetR[1]-r,2.0*r,2.0*r)
+			closeNotes = staff.recurseGetIntersectRect(area,mus.Note)
+
+			if len(closeNotes) > 0:
+				a = mus.Accent(closeNotes[0],mus.ACC_RHYTHM_DOT)
+				self.pad.drawObject(a)
+			else:
+				area = Rect(centerOffsetS[0]-r,centerOffsetS[1]-r,2.0*r,2.0*r)
+				closeNotes = staff.recurseGetIntersectRect(area,mus.Note)
+				if len(closeNotes) > 0:
+					a = mus.Accent(closeNotes[0],mus.ACC_STACCATO)
+					self.pad.drawObject(a)
+				else:
+					print "nowhere to put " + type
+
+		elif (type == 'hline' and rect.w < 1.5*mus.STAFFSPACING):
+			print "marcato!"
+
+		elif type == 'vline':
+			# Find the closest staff
+			staff, dist = self.getClosestStaff(rect.center)
+
+			# Find the lines which the line starts and ends at
+			endlines = [staff.whichLine(rect.top),staff.whichLine(rect.bottom)]
+
+			# TODO: add all notes, and have stem sort it out?
+			# TODO: choose closest for base?
+			r = mus.STAFFSPACING*0.25
+			closeTopNotes = staff.recurseGetIntersectRect(Rect(rect.centerx-r,rect.top-r,2.0*r,2.0*r),mus.Note)
+			closeBotNotes = staff.recurseGetIntersectRect(Rect(rect.centerx-r,rect.bottom-r,2.0*r,2.0*r),mus.Note)
+
+			# If the vertical line's top or bottom is close to a note,
+			# then we make it a stem of that note, TODO: giving preference
+			# to the closest note (bottom if they are equal)
+			if len(closeBotNotes) > 0 or len(closeTopNotes) > 0:
+				stemLen = abs(endlines[0]-endlines[1])
+				if len(closeBotNotes) > 0:
+					stem = mus.Stem(staff,(rect.centerx,closeBotNotes[0]._line),
+					                stemLen,1,[closeBotNotes[0]])
+				else:
+					stem = mus.Stem(staff,(rect.centerx,closeTopNotes[0]._line),
+					                stemLen,-1,[closeTopNotes[0]])
+
+				# Find any other notes within range of the stem and attach them
+				area = Rect(rect.centerx-mus.STAFFSPACING*0.25,rect.centery-stemLen*0.5,mus.STAFFSPACING*0.5,stemLen)
+
+				chordNotes = staff.recurseGetIntersectRect(area,mus.Note)
+				stem.addNotes(chordNotes)
+
+				# Redraw
+				self.pad.redraw()
+
+			# Otherwise, for it to be a barline, it must start and end
+			# at the staff's top and bottom line
+			# TODO: Change these values to a staff constant, based on 
+			# staff type
+			elif (endlines[0] in [-3,-4,-5] and endlines[1] in [3,4,5]):
+				barline = mus.Barline(staff,rect.centerx)
+				# draw barline
+				self.pad.drawObject(barline)
+			else:
+				print "unrecognized vertical line"
+		elif type == 'hline':
+			if 0:
+				pass
+			else:
+				print "unrecognized horizontal line"
+		elif type == 'rline':
+			print "right line recognized"
+		elif type == 'lline':
+			print "left line recognized"
+		else:
+			print "unhandled shape"
+			# TODO: color unrecognized stuff red?
@@ -0,0 +1,100 @@
+"""
+This file draws music objects onto pygame surfaces.  It is kept separate from
+MusicObjects, so that the objects themselves (and the recognition code that
+builds them) can be used without pygame.
+"""
+
+import pygame
+from numpy import *
+import MusicObjects as mus
+from MusicObjects import STAFFSPACING
+
+BLACK = pygame.Color("black")
+
+def draw(obj,canvas,scale):
+	"""
+	  Draw the object and all of its children.
+	"""
+	drawObject(obj,canvas,scale)
+	for child in obj._children:
+		draw(child,canvas,scale)
+
+def drawObject(obj,canvas,scale):
+	"""
+	  Draw only the object itself (not its children).
+	"""
+	drawFunction = _drawFunctions.get(obj.__class__)
+	if drawFunction:
+		drawFunction(obj,canvas,scale)
+
+def _drawStaff(staff,canvas,scale):
+	for i in [-2,-1,0,1,2]:
+		h = int((i*STAFFSPACING+staff._yMiddle))
+		pygame.draw.line(canvas, BLACK, (0,h), (staff._width,h), int(1.0))
+
+def _drawBarline(barline,canvas,scale):
+	x = barline._xPos
+	t = barline._rect.top
+	b = barline._rect.bottom
+	pygame.draw.line(canvas,BLACK,(x,t),(x,b),2)
+
+def _drawAccent(accent,canvas,scale):
+	rect = accent._rect
+	if accent._style == mus.ACC_RHYTHM_DOT or accent._style == mus.ACC_STACCATO:
+		pygame.draw.circle(canvas,BLACK,[int(round(rect.centerx)),int(round(rect.centery))], int(round(0.1*STAFFSPACING/2.0)))
+
+def _drawAccidental(accidental,canvas,scale):
+	rect = accidental._rect
+	if accidental._style == mus.ACC_SHARP:
+		# Vertical lines
+		pygame.draw.line(canvas,BLACK,(rect.left+rect.w*0.33,rect.top),(rect.left+rect.w*0.33,rect.bottom),2)
+		pygame.draw.line(canvas,BLACK,(rect.left+rect.w*0.66,rect.top),(rect.left+rect.w*0.66,rect.bottom),2)
+		# Horizontal lines
+		pygame.draw.line(canvas,BLACK,(rect.left,rect.h*0.40+rect.top),(rect.right,rect.w*0.26+rect.top),2)
+		pygame.draw.line(canvas,BLACK,(rect.left,rect.h*0.73+rect.top),(rect.right,rect.w*0.59+rect.top),2)
+	elif accidental._style == mus.ACC_FLAT:
+		pygame.draw.line(canvas,BLACK,(rect.left,rect.top),(rect.left,rect.bottom),2)
+		pygame.draw.arc(canvas,BLACK,pygame.Rect(rect.left-rect.w,rect.top+rect.h*0.34,rect.w*2.0,rect.h*0.68),-pi/2,0,2)
+		pygame.draw.arc(canvas,BLACK,pygame.Rect(rect.left-rect.w/3.0,rect.top+rect.h*0.5,rect.w*4.0/3.0,rect.h*0.34),0,pi/2,2)
+		pygame.draw.line(canvas,BLACK,(rect.left,rect.top+rect.h*0.67),(rect.left+rect.w/3.0,rect.top+rect.h/2.0),2)
+	elif accidental._style == mus.ACC_NATURAL:
+		pygame.draw.line(canvas,BLACK,(rect.left,rect.top),(rect.left,rect.top+rect.h*0.7),1)
+		pygame.draw.line(canvas,BLACK,(rect.right,rect.top+rect.h*0.3),(rect.right,rect.bottom),1)
+		pygame.draw.line(canvas,BLACK,(rect.left,rect.top+rect.h*0.4),(rect.right,rect.top+rect.h*0.2),3)
+		pygame.draw.line(canvas,BLACK,(rect.left,rect.top+rect.h*0.8),(rect.right,rect.top+rect.h*0.6),3)
+
+def _drawNote(note,canvas,scale):
+	if note._parent.__class__ == mus.Staff:
+		staffMiddle = note._parent._yMiddle
+	elif note._parent.__class__ == mus.Stem:
+		staffMiddle = note._parent._parent._yMiddle
+
+	if note._style == mus.NOTE_FILLED:
+		pygame.draw.circle(canvas,BLACK,[int(round(note._x)),int(round(note._y))], int(round(STAFFSPACING/2.0)))
+	elif note._style == mus.NOTE_EMPTY:
+		pygame.draw.circle(canvas,BLACK,[int(round(note._x)),int(round(note._y))], int(round(STAFFSPACING/2.0)), 2)
+
+	# Draw ledger lines if the note is...
+	# ...above the staff, or...
+	for line in range(int(ceil(note._line/2.))*2,-4,2):
+		h = int((staffMiddle+(line/2)*STAFFSPACING)*scale)
+		pygame.draw.line(canvas, BLACK, (note._x-(STAFFSPACING/1.5)*scale,h), (note._x+(STAFFSPACING/1.5),h), int(1.0))
+	# below the staff
+	for line in range(6,int(note._line/2)*2+2,2):
+		h = int((staffMiddle+(line/2)*STAFFSPACING)*scale)
+		pygame.draw.line(canvas, BLACK, (note._x-(STAFFSPACING/1.5)*scale,h), (note._x+(STAFFSPACING/1.5),h), int(1.0))
+
+def _drawStem(stem,canvas,scale):
+	x = stem._xPos
+	t = stem._rect.top
+	b = stem._rect.bottom
+	pygame.draw.line(canvas,BLACK,(x,t),(x,b),2)
+
+_drawFunctions = {
+	mus.Staff: _drawStaff,
+	mus.Barline: _drawBarline,
+	mus.Accent: _drawAccent,
+	mus.Accidental: _drawAccidental,
+	mus.Note: _drawNote,
+	mus.Stem: _drawStem,
+}
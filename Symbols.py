@@ -1,9 +1,217 @@
 # This file is dedicated to the classification of shapes drawn by the user into
-# a set of symbols allowed by the program.  The individual symbols are stored in
-# the symbols directory, and they have a template file for each size.
+# a set of symbols allowed by the program.  The templates for the individual
+# symbols are stored in a single file in the symbols directory (see
+# Templates.py).
 
+import os
+import hashlib
 import numpy as np
+from collections import OrderedDict
 from math import pow, sqrt, pi, exp, atan2
+from time import time
+
+import Templates
+import Neighbours
+
+# The symbols that a shape can be classified as (other than lines)
+templates = ['dot','circle','flat','sharp','natural','hat','sm_dot']
+
+# The file that all of the symbol templates are packed into
+TEMPLATEFILE = os.path.join('symbols','templates.bank')
+# The log that every training sample is appended to
+SAMPLEFILE = os.path.join('symbols','samples.log')
+
+# TODO: put this into config file
+# Minimum number of seconds between checks for a modified template file
+TEMPLATECHECKINTERVAL = 1.0
+# Maximum distance (in pixels) of any point of a line from the line between its
+# end points
+LINETOLERANCE = 3.5
+# Shapes that score below this for every template are left unclassified
+MINSCORE = 0.2
+# Maximum number of shapes that classify_batch scores in a single pass
+BATCHSIZE = 1024
+# Smallest standard deviation a density grid cell is scored with (cells that
+# are empty in every training sample would otherwise have none)
+MINDENSITYSIGMA = 0.05
+# Number of nearest training samples that vote on a shape's symbol ('knn')
+KNN = 5
+# Shapes farther than this from every training sample (in normalized feature
+# units; see Neighbours) are left unclassified by 'knn'
+KNNMAXDISTANCE = np.inf
+# The ways that classify can compare shapes to templates (or samples)
+METHODS = ['projections','density','knn']
+# Number of classification results that classify remembers (0 turns the cache
+# off; see ResultCache)
+CACHESIZE = 0
+# Features are rounded to multiples of this before they are used as a cache key
+CACHEQUANTUM = 0.01
+# Maximum number of points that a Stroke keeps (its features are still
+# computed from every point)
+MAXSTROKEPOINTS = 512
+
+class TemplateBank:
+	"""
+	  The template bank keeps the classification statistics (mean and standard
+	  deviation) of every symbol template in memory.  Each feature is stacked
+	  into a single array with one row per template, so that classifying a
+	  shape does not require going to disk.  The arrays are memory-mapped from
+	  the template file, so they are shared by every process using the bank.
+
+	  The file is only read again if its modification time has changed
+	  (checked at most every TEMPLATECHECKINTERVAL seconds), or if the bank is
+	  explicitly told to refresh (e.g. after training).
+	"""
+	def __init__(self,path):
+		self.path = path
+		self.names = []
+		# Counts the times the templates have been (re)loaded
+		self.version = 0
+		self._mtime = None
+		self._lastCheck = -np.inf
+
+	def load(self):
+		"""
+		  (Re)load the template file.
+		"""
+		mtime = os.stat(self.path).st_mtime
+		names, blocks = Templates.read(self.path)
+
+		self.names = names
+		self.xProjMu = blocks['xproj_mu']
+		self.xProjSigma = blocks['xproj_sigma']
+		self.yProjMu = blocks['yproj_mu']
+		self.yProjSigma = blocks['yproj_sigma']
+		# Sizes are stored as [h,w]
+		self.sizeMu = blocks['size_mu']
+		self.sizeSigma = blocks['size_sigma']
+		self.densityMu = blocks['density_mu']
+		self.densitySigma = np.maximum(blocks['density_sigma'],MINDENSITYSIGMA)
+		# Templates trained before density grids were recorded have none
+		self.hasDensity = blocks['density_n'][:,0] > 0
+
+		self.version += 1
+		self._mtime = mtime
+		self._lastCheck = time()
+
+	def refresh(self):
+		"""
+		  Force the templates to be reloaded the next time they are used.
+		"""
+		self._mtime = None
+
+	def current(self):
+		"""
+		  Returns the bank, making sure that its contents match the file on
+		  disk.
+		"""
+		if self._mtime is None:
+			self.load()
+		elif time()-self._lastCheck > TEMPLATECHECKINTERVAL:
+			self._lastCheck = time()
+			if os.stat(self.path).st_mtime != self._mtime:
+				self.load()
+		return self
+
+templateBank = TemplateBank(TEMPLATEFILE)
+sampleIndex = Neighbours.SampleIndex(SAMPLEFILE)
+
+class ResultCache:
+	"""
+	  Remembers what recent shapes were classified as, keyed by a hash of
+	  their (quantized) features, so that classifying the same shape again
+	  (e.g. when a session is replayed) skips scoring altogether.
+
+	  The cache holds up to size results; once it is full, the least recently
+	  used result is evicted (policy 'lru'), or the oldest one ('fifo').  A
+	  result is never returned once the templates (or, for 'knn', the samples)
+	  that it was computed from have changed.
+	"""
+	def __init__(self,size=CACHESIZE,policy='lru'):
+		# (version, result) pairs, oldest (or least recently used) first
+		self._results = OrderedDict()
+		self.resize(size,policy)
+		self.resetCounters()
+
+	def resize(self,size,policy=None):
+		"""
+		  Changes the number of results kept (0 turns the cache off), and
+		  optionally the eviction policy.
+		"""
+		if policy is not None:
+			if policy not in ['lru','fifo']:
+				raise ValueError('unknown eviction policy: ' + str(policy))
+			self.policy = policy
+		self.size = size
+		self._evict()
+
+	def resetCounters(self):
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.invalidations = 0
+
+	def clear(self):
+		self._results.clear()
+
+	def __len__(self):
+		return len(self._results)
+
+	def key(self,method,features):
+		quantized = np.round(np.concatenate([np.ravel(feature) for feature in features])/CACHEQUANTUM)
+		return method, hashlib.sha1(quantized.astype(np.int64).tostring()).digest()
+
+	def get(self,key,version):
+		"""
+		  Returns the remembered result for the key, or None.  The version
+		  identifies the templates in use; a result computed with other
+		  templates is dropped.
+		"""
+		entry = self._results.get(key)
+		if entry is not None and entry[0] != version:
+			del self._results[key]
+			self.invalidations += 1
+			entry = None
+		if entry is None:
+			self.misses += 1
+			return None
+
+		self.hits += 1
+		if self.policy == 'lru':
+			# Move the result to the (most recently used) end
+			del self._results[key]
+			self._results[key] = entry
+		return entry[1]
+
+	def put(self,key,version,result):
+		if self.size <= 0:
+			return
+		self._results[key] = (version,result)
+		self._evict()
+
+	def _evict(self):
+		while len(self._results) > max(self.size,0):
+			self._results.popitem(last=False)
+			self.evictions += 1
+
+	def hitRate(self):
+		lookups = self.hits + self.misses
+		if lookups == 0:
+			return 0.0
+		return self.hits/float(lookups)
+
+	def stats(self):
+		return {
+			'size': self.size,
+			'entries': len(self._results),
+			'hits': self.hits,
+			'misses': self.misses,
+			'hit_rate': self.hitRate(),
+			'evictions': self.evictions,
+			'invalidations': self.invalidations,
+		}
+
+resultCache = ResultCache()
 
 def center(shape):
 	mnpts = np.amin(shape,0)
@@ -13,179 +221,713 @@ def center(shape):
 	return [mnpts[0]+w/2,mnpts[1]+h/2]
 
 def boundingBox(shape):
+	if isinstance(shape,Stroke):
+		return shape.boundingBox()
 	mnpts = np.amin(shape,0)
 	mxpts = np.amax(shape,0)
 	return (mnpts,mxpts)
 
-""" This function returns the true if the coordinates given define a line from
-the first to last; otherwise, it returns false.  The condition to be a line is
-that every point must be a distance less than or equal to 3 pixels away from a
-line directly between the start and end points. """
-#TODO: this could be sped up via a better algorithm
 def isLine(coords):
+	"""
+	  This function returns the true if the coordinates given define a line
+	  from the first to last; otherwise, it returns false.  The condition to be
+	  a line is that every point must be a distance less than or equal to
+	  LINETOLERANCE pixels away from a line directly between the start and end
+	  points.
+	"""
+	coords = np.asarray(coords,float)
 	start = coords[0,0:2] #x,y
 	end = coords[-1,0:2] #x,y
-	normLine = (end-start)/np.sqrt(np.dot(end-start,end-start))
-	for i in range(np.size(coords,0)):
-		newPoint = coords[i,0:2]
-		newLen = np.sqrt(np.dot(newPoint-start,newPoint-start))
-		angleBetween = np.arccos(np.dot((newPoint-start),normLine)/newLen)
-		if abs(np.sin(angleBetween)*newLen) > 3.5:
-			return False
-	return True
-	
-def classify(shape):
+	return bool(np.all(_lineDeviation(coords[:,0:2],start,end) <= LINETOLERANCE))
+
+def _lineDeviation(points,start,end):
 	"""
-	  This function contains the logic to classify the shape into a basic
-	  symbol; i.e., a vertical line, empty circle, filled circle, sharp, flat,
-	  etc.
-	  This is done by first sorting by size and aspect ratio, and then comparing	  the object to a list of approprate symbols templates.  These symbol
-	  templates are smaller grids that represent the density of pixels in a
-	  larger binary image.
+	  Returns the perpendicular distance of each point from the line through
+	  start and end (or just the distance to start if they are the same point).
+	"""
+	direction = end-start
+	offsets = points-start
+	length = sqrt(np.dot(direction,direction))
+	if length == 0:
+		return np.sqrt(np.sum(offsets*offsets,1))
+	# The cross product with the direction gives the perpendicular distance
+	return np.abs(direction[0]*offsets[:,1]-direction[1]*offsets[:,0])/length
 
-	  After comparing to the existing templates, a score is computed, and the
-	  highest score is chosen.
+class LineTracker:
+	"""
+	  This keeps track of whether the points of a shape form a line (in the
+	  same sense as isLine) as they are added, so that the answer is already
+	  known when the shape is finished.
+
+	  The point farthest from any line is always a corner of the convex hull of
+	  the points, so only the hull is kept (each point is spliced into it as
+	  it is added, see _addToHull), and the maximum deviation is recomputed
+	  from it whenever the end point moves.  Once the points are too wide for
+	  any line to pass close enough to all of them, the shape can't become a
+	  line again, so the hull is dropped and later points only move the end.
+	"""
+	def __init__(self):
+		self.start = None
+		self.end = None
+		self.deviation = 0.0
+		# Corners of the convex hull, in counter-clockwise order
+		self._hull = np.zeros([0,2])
+
+	def add(self,point):
+		point = np.array(point[0:2],float)
+		if self.start is None:
+			self.start = point
+		self.end = point
+		if self._hull is None:
+			return
+		if len(self._hull) < 3:
+			self._hull = _convexHull(np.vstack((self._hull,point)))
+		else:
+			self._hull = _addToHull(self._hull,point)
+		deviations = _lineDeviation(self._hull,self.start,self.end)
+		farthest = np.argmax(deviations)
+		self.deviation = deviations[farthest]
+		if self._tooWide(self._hull[farthest]):
+			self._hull = None
+			self.deviation = np.inf
+
+	def isLine(self):
+		return self.deviation <= LINETOLERANCE
+
+	def _tooWide(self,corner):
+		"""
+		  Whether the triangle of the start, the end and the corner is more
+		  than 2*LINETOLERANCE wide in every direction, in which case so are
+		  the points, and no line is within LINETOLERANCE of all of them.
+		"""
+		sides = [self.end-self.start,corner-self.start,corner-self.end]
+		lengths = [sqrt(np.dot(side,side)) for side in sides]
+		# The triangle is narrowest across its longest side, where it is as
+		# wide as the corner's deviation times the start to end length, over
+		# the longest side
+		longest = max(lengths)
+		return longest > 0 and self.deviation*lengths[0]/longest > 2*LINETOLERANCE
+
+def _addToHull(hull,point):
 	"""
-	# Shape is a set of x/y coordinates:
-	shape = np.array(shape)
+	  Returns the convex hull (corners in counter-clockwise order) of a convex
+	  hull of three or more corners and a point.  The edges that the point is
+	  outside of (to the right of, or in line with) are a run of neighbouring
+	  edges, and the corners between them are replaced by the point.
+	"""
+	# The cross product of each edge with the point's offset from its start
+	# (which is the cross product of the point's offsets from the edge's ends)
+	offsets = point-hull
+	crosses = np.empty(len(hull))
+	crosses[:-1] = offsets[:-1,0]*offsets[1:,1]-offsets[:-1,1]*offsets[1:,0]
+	crosses[-1] = offsets[-1,0]*offsets[0,1]-offsets[-1,1]*offsets[0,0]
+	if crosses[np.argmin(crosses)] >= 0:
+		return hull
+	visible = np.flatnonzero(crosses <= 0)
+	if visible[0] == 0 and visible[-1] == len(hull)-1:
+		# The run wraps around, so the corners kept are all in the middle
+		gap = np.flatnonzero(np.diff(visible) > 1)[0]
+		return np.vstack((hull[visible[gap]+1:visible[gap+1]+1],point))
+	return np.vstack((hull[visible[-1]+1:],hull[:visible[0]+1],point))
+
+def _convexHull(points):
+	"""
+	  Returns the corners of the convex hull of the points in counter-clockwise
+	  order (Andrew's monotone chain algorithm).
+	"""
+	points = sorted(set(map(tuple,points)))
+	if len(points) < 3:
+		return np.array(points,float).reshape([-1,2])
+
+	def cross(o,a,b):
+		return (a[0]-o[0])*(b[1]-o[1]) - (a[1]-o[1])*(b[0]-o[0])
+
+	lower = []
+	for p in points:
+		while len(lower) >= 2 and cross(lower[-2],lower[-1],p) <= 0:
+			lower.pop()
+		lower.append(p)
+	upper = []
+	for p in reversed(points):
+		while len(upper) >= 2 and cross(upper[-2],upper[-1],p) <= 0:
+			upper.pop()
+		upper.append(p)
+	return np.array(lower[:-1]+upper[:-1],float)
+
+def lineType(shape):
+	"""
+	  If the shape is a line, this returns which kind of line it is ('vline',
+	  'hline', 'lline' or 'rline'); otherwise, it returns None.
+	"""
+	if isinstance(shape,Stroke):
+		return shape.lineType()
+
+	shape = np.asarray(shape)
 	mnpts = np.amin(shape,0)
 	mxpts = np.amax(shape,0)
 	w = mxpts[0] - mnpts[0] + 1
 	h = mxpts[1] - mnpts[1] + 1
 
 	if w+h > 10 and isLine(shape):
-		x = shape[-1,0] - shape[0,0]
-		y = shape[-1,1] - shape[0,1]
-		# ensures positive angle between 0 and pi
-		angle = np.fmod(atan2(y,x)+2*pi,pi)
-		if .9*pi/2 < angle < 1.1*pi/2:
-			return 'vline'
-		elif 1.9*pi/2 < angle or angle < 0.1*pi/2:
-			return 'hline'
-		elif angle < pi/2:
-			return 'lline' # Left slanting line
-		else:
-			return 'rline' # Right slanting line
+		return _lineDirection(shape[0],shape[-1])
+	return None
+
+def _lineDirection(start,end):
+	x = end[0] - start[0]
+	y = end[1] - start[1]
+	# ensures positive angle between 0 and pi
+	angle = np.fmod(atan2(y,x)+2*pi,pi)
+	if .9*pi/2 < angle < 1.1*pi/2:
+		return 'vline'
+	elif 1.9*pi/2 < angle or angle < 0.1*pi/2:
+		return 'hline'
+	elif angle < pi/2:
+		return 'lline' # Left slanting line
+	else:
+		return 'rline' # Right slanting line
+
+def projections(shape):
+	"""
+	  Computes the features that shapes are compared to templates with: the x
+	  and y projections of the shape's binary image (resampled to 101 points
+	  each), and its size as [h,w].
+
+	  The binary image is never built; the projections are counted straight
+	  from the points, so this uses O(n + w + h) memory.
+	"""
+	if isinstance(shape,Stroke):
+		return shape.projections()
+
+	shape = np.asarray(shape,int)
+	mnpts = np.amin(shape,0)
+	mxpts = np.amax(shape,0)
+	w = mxpts[0] - mnpts[0] + 1
+	h = mxpts[1] - mnpts[1] + 1
 
-	# Transform into a binary image
-	shapeBinary = np.zeros([h,w],int)
-	for i in range(np.size(shape,0)):
-		shapeBinary[shape[i,1]-mnpts[1],shape[i,0]-mnpts[0]] = 1;
+	# Index of each point's pixel in the (row-major) binary image, so that
+	# pixels visited more than once are only counted once
+	pixels = np.unique((shape[:,1]-mnpts[1])*w + (shape[:,0]-mnpts[0]))
 
 	# Compute the projections of the shape
-	xProj = np.sum(shapeBinary,0)
-	yProj = np.sum(shapeBinary,1)
+	xProj = np.bincount(pixels % w,minlength=w)
+	yProj = np.bincount(pixels // w,minlength=h)
+	return _normalizeProjections(xProj,yProj)
+
+def densityGrid(shape):
+	"""
+	  Computes the density grid of the shape's binary image (see
+	  densityTransform), flattened to Templates.DENSITYSIZE[0]*[1] values.
+
+	  As with projections, the binary image is never built.
+	"""
+	if isinstance(shape,Stroke):
+		return shape.densityGrid()
+
+	shape = np.asarray(shape,int)
+	mnpts = np.amin(shape,0)
+	mxpts = np.amax(shape,0)
+	w = mxpts[0] - mnpts[0] + 1
+	h = mxpts[1] - mnpts[1] + 1
+
+	pixels = np.unique((shape[:,1]-mnpts[1])*w + (shape[:,0]-mnpts[0]))
+	return _pixelDensity(pixels // w,pixels % w,h,w)
+
+def _pixelDensity(rows,columns,h,w):
+	"""
+	  The density grid of an h x w binary image, given the row and column of
+	  each of its (distinct) set pixels.  This is densityTransform of the
+	  image, summed pixel by pixel: O(n) in the number of pixels, not O(w*h).
+	"""
+	rowOverlap = _overlapMatrix(h,Templates.DENSITYSIZE[0])
+	columnOverlap = _overlapMatrix(w,Templates.DENSITYSIZE[1])
+	return np.dot(rowOverlap[:,rows],columnOverlap[:,columns].T).ravel()
+
+def _normalizeProjections(xProj,yProj):
+	w = len(xProj)
+	h = len(yProj)
 	xProjNorm = np.interp(np.linspace(0,1,101),np.linspace(0,1,w),xProj)
 	yProjNorm = np.interp(np.linspace(0,1,101),np.linspace(0,1,h),yProj)
-	xProjNorm = np.reshape(xProjNorm,[1,101])
-	yProjNorm = np.reshape(yProjNorm,[1,101])
+	return xProjNorm, yProjNorm, np.array([h,w])
 
-	templates = ['dot','circle','flat','sharp','natural','hat','sm_dot']
+class Stroke:
+	"""
+	  A stroke collects the points of a shape as it is being drawn, and keeps
+	  the features needed to classify it (bounding box, x/y projections and
+	  line statistics) up to date as each point is appended.  That way, when
+	  the shape is finished, only the template scoring is left to do.
 
-	# Compute a score for each template
+	  A stroke can be passed anywhere a list of points is accepted (classify,
+	  classify_batch, train).
+
+	  Since the features are kept up to date, the points themselves are only
+	  kept for drawing and inspection, in a fixed size buffer: a point is only
+	  kept once it is at least a minimum spacing from the one before it (the
+	  last point is always the latest one appended), and whenever the buffer
+	  fills up, the spacing is doubled and the points that are now too close
+	  together are dropped.  So a stroke never holds more than MAXSTROKEPOINTS
+	  points, however long the pen is down.
+	"""
+	def __init__(self,points=()):
+		self._points = np.zeros([MAXSTROKEPOINTS,2],np.int32)
+		self._count = 0
+		self._spacing = 1.0
+		# Pixels that have been visited, and how many of them are in each
+		# column (for the x projection) and row (for the y projection)
+		self._pixels = set()
+		self._columnCounts = {}
+		self._rowCounts = {}
+		self._min = None
+		self._max = None
+		self._line = LineTracker()
+		for point in points:
+			self.append(point)
+
+	def append(self,point):
+		x = int(point[0])
+		y = int(point[1])
+		if self._count > 0 and self._points[self._count-1,0] == x and self._points[self._count-1,1] == y:
+			return
+		self._keep(x,y)
+		self._line.add((x,y))
+
+		if self._min is None:
+			self._min = [x,y]
+			self._max = [x,y]
+		else:
+			self._min = [min(self._min[0],x),min(self._min[1],y)]
+			self._max = [max(self._max[0],x),max(self._max[1],y)]
+
+		if (x,y) not in self._pixels:
+			self._pixels.add((x,y))
+			self._columnCounts[x] = self._columnCounts.get(x,0) + 1
+			self._rowCounts[y] = self._rowCounts.get(y,0) + 1
+
+	def _keep(self,x,y):
+		n = self._count
+		# The last point is replaced, rather than kept, until it is far enough
+		# from the one before it
+		if n >= 2 and _distance(self._points[n-2],self._points[n-1]) < self._spacing:
+			self._points[n-1] = (x,y)
+			return
+		self._points[n] = (x,y)
+		self._count += 1
+		while self._count == MAXSTROKEPOINTS:
+			self._resample(2*self._spacing)
+
+	def _resample(self,spacing):
+		"""
+		  Drops the points that are closer than spacing to the previous point
+		  kept (except for the last point).
+		"""
+		kept = 1
+		for i in range(1,self._count-1):
+			if _distance(self._points[kept-1],self._points[i]) >= spacing:
+				self._points[kept] = self._points[i]
+				kept += 1
+		self._points[kept] = self._points[self._count-1]
+		self._count = kept + 1
+		self._spacing = spacing
+
+	def __len__(self):
+		return self._count
+
+	def __getitem__(self,index):
+		return self._points[:self._count][index]
+
+	def points(self):
+		return self._points[:self._count].astype(int)
+
+	def boundingBox(self):
+		return (np.array(self._min),np.array(self._max))
+
+	def lineType(self):
+		w = self._max[0] - self._min[0] + 1
+		h = self._max[1] - self._min[1] + 1
+		if w+h > 10 and self._line.isLine():
+			return _lineDirection(self._line.start,self._line.end)
+		return None
+
+	def densityGrid(self):
+		pixels = np.array(list(self._pixels),int).reshape([-1,2]) - self._min
+		return _pixelDensity(pixels[:,1],pixels[:,0],self._max[1]-self._min[1]+1,self._max[0]-self._min[0]+1)
+
+	def projections(self):
+		xProj = np.zeros(self._max[0]-self._min[0]+1,int)
+		yProj = np.zeros(self._max[1]-self._min[1]+1,int)
+		xProj[np.array(self._columnCounts.keys())-self._min[0]] = self._columnCounts.values()
+		yProj[np.array(self._rowCounts.keys())-self._min[1]] = self._rowCounts.values()
+		return _normalizeProjections(xProj,yProj)
+
+def _distance(a,b):
+	return sqrt(float(a[0]-b[0])**2 + float(a[1]-b[1])**2)
+
+def _sigmoidScore(mu,sigma,value):
+	"""
+	  Uses a sigmoid to approximate the normal CDF of value's distance from the
+	  mean.
+	"""
+	return 2/(1+np.exp(1.7*np.abs(mu-value)/sigma))
+
+def scoreTemplates(xProjNorm,yProjNorm,size,bank):
+	"""
+	  Scores N shapes against all T templates of the bank at once.  The inputs
+	  are the N x 101 projections and the N x 2 sizes computed by
+	  projections(), and the result is an N x T array of scores.
+	"""
+	# Features are broadcast to N x T x (number of features)
+	xProjNorm = xProjNorm[:,np.newaxis,:]
+	yProjNorm = yProjNorm[:,np.newaxis,:]
+	size = size[:,np.newaxis,:]
+
+	xProjScore = np.mean(_sigmoidScore(bank.xProjMu,bank.xProjSigma,xProjNorm),2)
+	yProjScore = np.mean(_sigmoidScore(bank.yProjMu,bank.yProjSigma,yProjNorm),2)
+	sizeScore = np.prod(_sigmoidScore(bank.sizeMu,bank.sizeSigma,size),2)
+
+	return np.sqrt(np.sqrt(xProjScore*yProjScore*sizeScore))
+
+def scoreDensity(xProjNorm,yProjNorm,size,density,bank):
+	"""
+	  Scores N shapes against all T templates of the bank at once, like
+	  scoreTemplates, but comparing the shapes' N x (grid size) density grids
+	  (see densityGrid) in place of both of their projections.  Templates
+	  without density statistics are scored on their projections instead.
+	"""
+	size = size[:,np.newaxis,:]
+	density = density[:,np.newaxis,:]
+
+	densityScore = np.mean(_sigmoidScore(bank.densityMu,bank.densitySigma,density),2)
+	sizeScore = np.prod(_sigmoidScore(bank.sizeMu,bank.sizeSigma,size),2)
+	scores = np.sqrt(np.sqrt(densityScore*densityScore*sizeScore))
+
+	if not np.all(bank.hasDensity):
+		projectionScores = scoreTemplates(xProjNorm,yProjNorm,size[:,0,:],bank)
+		scores[:,~bank.hasDensity] = projectionScores[:,~bank.hasDensity]
+	return scores
+
+def _bestTemplate(scores):
+	"""
+	  Returns the index of the highest scoring template, or None if no
+	  template scores high enough.
+	"""
+	best = np.argmax(scores)
+	if scores[best] < MINSCORE:
+		return None
+	return best
+
+def _cascadeBestTemplate(xProjNorm,yProjNorm,size,bank,density=None):
+	"""
+	  Finds the same template as _bestTemplate(scoreTemplates(...)) for a single
+	  shape (or _bestTemplate(scoreDensity(...)), if the density grid is
+	  given), but without comparing projections for templates that cannot win.
+
+	  The projection (and density) scores are never more than one, so the
+	  (cheap) size score alone gives an upper bound on each template's final
+	  score.  Templates are tried from the highest bound down, and the search
+	  stops as soon as the bound falls below the best score so far (or
+	  MINSCORE).
+	"""
+	sizeScore = np.prod(_sigmoidScore(bank.sizeMu,bank.sizeSigma,size),1)
+	bound = np.sqrt(np.sqrt(sizeScore))
+
+	best = None
+	bestScore = MINSCORE
+	for i in np.argsort(-bound,kind='mergesort'):
+		if bound[i] < bestScore:
+			break
+		if density is not None and bank.hasDensity[i]:
+			densityScore = np.mean(_sigmoidScore(bank.densityMu[i],bank.densitySigma[i],density))
+			score = sqrt(sqrt(densityScore*densityScore*sizeScore[i]))
+		else:
+			xProjScore = np.mean(_sigmoidScore(bank.xProjMu[i],bank.xProjSigma[i],xProjNorm))
+			yProjScore = np.mean(_sigmoidScore(bank.yProjMu[i],bank.yProjSigma[i],yProjNorm))
+			score = sqrt(sqrt(xProjScore*yProjScore*sizeScore[i]))
+		# Ties go to the first template, as with np.argmax
+		if score > bestScore or (score == bestScore and (best is None or i < best)):
+			best = i
+			bestScore = score
+	return best
+
+def _neighbourVotes(xProjNorm,yProjNorm,size):
+	"""
+	  Classifies N shapes by the symbols of their KNN nearest training samples,
+	  returning each one's symbol and the fraction of the neighbours that voted
+	  for it.  Ties go to the symbol of the nearest neighbour among them.
+	"""
+	index = sampleIndex.current()
+	distances, neighbours = index.nearest({'xproj':xProjNorm,'yproj':yProjNorm,'size':size},KNN)
+
+	symbols = []
 	scores = []
-	for name in templates:
-		xProjTemplate = np.load('symbols/' + name + '-xproj_mu_sigma.npy');
-		yProjTemplate = np.load('symbols/' + name + '-yproj_mu_sigma.npy');
-		sizeTemplate = np.load('symbols/' + name + '-size_mu_sigma.npy');
-
-		# Use a sigmoid to approximate the normal CDF for each of these scores
-		xProjScore = np.mean(2/(1+np.exp(1.7*np.abs(xProjTemplate[0,:]-xProjNorm)/xProjTemplate[1,:])))
-		yProjScore = np.mean(2/(1+np.exp(1.7*np.abs(yProjTemplate[0,:]-yProjNorm)/yProjTemplate[1,:])))
-		xSizeScore = 2/(1+np.exp(1.7*np.abs(sizeTemplate[0,1]-w)/np.abs(sizeTemplate[1,1])))
-		ySizeScore = 2/(1+np.exp(1.7*np.abs(sizeTemplate[0,0]-h)/np.abs(sizeTemplate[1,0])))
-
-		scores.append(sqrt(sqrt(xProjScore*yProjScore*xSizeScore*ySizeScore)))
-		
-	mxScore = max(scores)
-	if mxScore < 0.2:
+	for i in range(len(neighbours)):
+		if np.size(neighbours,1) == 0 or distances[i,0] > KNNMAXDISTANCE:
+			symbols.append('unclassified')
+			scores.append(0.0)
+			continue
+		votes = {}
+		for symbol in index.symbols[neighbours[i]]:
+			votes[symbol] = votes.get(symbol,0) + 1
+		# The neighbours are in order, nearest first
+		best = max(index.symbols[neighbours[i]],key=lambda symbol: votes[symbol])
+		symbols.append(str(best))
+		scores.append(votes[best]/float(np.size(neighbours,1)))
+	return symbols, scores
+
+def _templateName(index,bank):
+	if index is None:
 		return 'unclassified'
+	return bank.names[index]
+
+def classify(shape,cascade=False,method='projections'):
+	"""
+	  This function contains the logic to classify the shape into a basic
+	  symbol; i.e., a vertical line, empty circle, filled circle, sharp, flat,
+	  etc.
+	  This is done by first sorting by size and aspect ratio, and then comparing
+	  the object to a list of approprate symbols templates.  These symbol
+	  templates are smaller grids that represent the density of pixels in a
+	  larger binary image.
+
+	  After comparing to the existing templates, a score is computed, and the
+	  highest score is chosen.
+
+	  In cascade mode, templates that the shape's size rules out are rejected
+	  before their projections are compared (the result is the same).
+
+	  The method is one of METHODS: shapes are compared to the templates by
+	  their x and y projections ('projections'), or by their 2-D density grids
+	  ('density'; see scoreDensity), or are classified by the training samples
+	  that they are closest to ('knn'; see Neighbours).  Cascade mode does not
+	  apply to 'knn'.
+
+	  If resultCache has a size, shapes with the same features as one that
+	  was classified recently get the same result, without being scored.
+	"""
+	if method not in METHODS:
+		raise ValueError('unknown classification method: ' + str(method))
+
+	# Shape is a set of x/y coordinates (or a Stroke):
+	line = lineType(shape)
+	if line:
+		return line
+
+	xProjNorm, yProjNorm, size = projections(shape)
+	density = None
+	if method == 'density':
+		density = densityGrid(shape)
+
+	if resultCache.size <= 0:
+		return _classifyFeatures(xProjNorm,yProjNorm,size,density,cascade,method)
+
+	# The cached results are only good for the templates (or samples) they
+	# were computed from
+	if method == 'knn':
+		version = ('knn',sampleIndex.current().version)
+	else:
+		version = templateBank.current().version
+	key = resultCache.key(method,[feature for feature in [xProjNorm,yProjNorm,size,density] if feature is not None])
+	symbol = resultCache.get(key,version)
+	if symbol is None:
+		symbol = _classifyFeatures(xProjNorm,yProjNorm,size,density,cascade,method)
+		resultCache.put(key,version,symbol)
+	return symbol
+
+def _classifyFeatures(xProjNorm,yProjNorm,size,density,cascade,method):
+	if method == 'knn':
+		return _neighbourVotes(xProjNorm[np.newaxis],yProjNorm[np.newaxis],size[np.newaxis])[0][0]
+
+	bank = templateBank.current()
+
+	if cascade:
+		return _templateName(_cascadeBestTemplate(xProjNorm,yProjNorm,size,bank,density),bank)
+
+	# Compute a score for each template
+	if method == 'density':
+		scores = scoreDensity(xProjNorm[np.newaxis],yProjNorm[np.newaxis],size[np.newaxis],density[np.newaxis],bank)
 	else:
-		return templates[scores.index(mxScore)]
+		scores = scoreTemplates(xProjNorm[np.newaxis],yProjNorm[np.newaxis],size[np.newaxis],bank)
+
+	return _templateName(_bestTemplate(scores[0]),bank)
+
+def classify_batch(shapes,returnScores=False,method='projections'):
+	"""
+	  Classifies a list of shapes, returning a list of symbols in the same
+	  order.  This gives the same results as calling classify on each shape,
+	  but the template scores for all of the (non-line) shapes are computed
+	  together, BATCHSIZE shapes at a time.
+
+	  If returnScores is True, a list of the best template score for each
+	  shape is returned as well (None for lines, which are not scored).
+	"""
+	if method not in METHODS:
+		raise ValueError('unknown classification method: ' + str(method))
+
+	symbols = [None]*len(shapes)
+	bestScores = [None]*len(shapes)
+
+	# Lines are recognized without templates; everything else is scored
+	toScore = []
+	features = []
+	for i in range(len(shapes)):
+		shape = shapes[i]
+		symbols[i] = lineType(shape)
+		if not symbols[i]:
+			toScore.append(i)
+			if method == 'density':
+				features.append(projections(shape) + (densityGrid(shape),))
+			else:
+				features.append(projections(shape))
+
+	bank = templateBank.current()
+	for first in range(0,len(toScore),BATCHSIZE):
+		batch = features[first:first+BATCHSIZE]
+		xProjNorm = np.array([f[0] for f in batch])
+		yProjNorm = np.array([f[1] for f in batch])
+		size = np.array([f[2] for f in batch])
+		if method == 'knn':
+			batchSymbols, batchScores = _neighbourVotes(xProjNorm,yProjNorm,size)
+			for j in range(len(batch)):
+				symbols[toScore[first+j]] = batchSymbols[j]
+				bestScores[toScore[first+j]] = batchScores[j]
+			continue
+		if method == 'density':
+			scores = scoreDensity(xProjNorm,yProjNorm,size,np.array([f[3] for f in batch]),bank)
+		else:
+			scores = scoreTemplates(xProjNorm,yProjNorm,size,bank)
+		for j in range(len(batch)):
+			symbols[toScore[first+j]] = _templateName(_bestTemplate(scores[j]),bank)
+			bestScores[toScore[first+j]] = float(np.max(scores[j]))
+
+	if returnScores:
+		return symbols, bestScores
+	return symbols
 
 def densityTransform(input,out_size):
 	"""
-	  This maps the input binary image into a smaller grid, and assigns each
-	  block of this smaller grid a value equal to the proportion it is covered
-	  with black squares from the input image.
-	"""
-	# TODO: This should only work when inputsize is greater that outsize in
-	# each dimension.
-	w_in = np.size(input,1)
-	h_in = np.size(input,0)
-	w_out = out_size[1]
-	h_out = out_size[0]
-	output = np.zeros([h_out+1,w_out+1])
-
-	# Get the left/right and top/bottom input square edges into the output
-	# coordinate system.
-	x_edges = np.array(range(w_in+1))*np.double(w_out)/w_in
-	y_edges = np.array(range(h_in+1))*np.double(h_out)/h_in
-
-	w_tr = np.double(w_out)/w_in
-	h_tr = np.double(h_out)/h_in
-
-	dx = np.ceil(x_edges[:-1])-x_edges[:-1]
-	dy = np.ceil(y_edges[:-1])-y_edges[:-1]
-
-	# Add the relevant parts of each square to the final output
-	for i in range(h_in):
-		for j in range(w_in):
-			if input[i,j] == 1:
-				# Add the four divided area elements
-				output[np.floor(y_edges[i]),np.floor(x_edges[j])] += dy[i]*dx[j]
-				output[np.floor(y_edges[i+1]),np.floor(x_edges[j])] += (h_tr-dy[i])*dx[j]
-				output[np.floor(y_edges[i+1]),np.floor(x_edges[j+1])] += (h_tr-dy[i])*(w_tr-dx[j])
-				output[np.floor(y_edges[i]),np.floor(x_edges[j+1])] += dy[i]*(w_tr-dx[j])
-
-	return output[:-1,:-1]
+	  This maps the input binary image into a grid of out_size ([h,w]), and
+	  assigns each block of this grid a value equal to the proportion it is
+	  covered with black squares from the input image.  The grid may be
+	  larger or smaller than the image in either dimension.
+
+	  Each input square is stretched over the grid, so its coverage of a block
+	  is the product of its row's overlap with the block's row and its
+	  column's overlap with the block's column.  Summing over the image is
+	  then just two matrix products.
+	"""
+	input = np.asarray(input,float)
+	rowOverlap = _overlapMatrix(np.size(input,0),out_size[0])
+	columnOverlap = _overlapMatrix(np.size(input,1),out_size[1])
+	return np.dot(np.dot(rowOverlap,input),columnOverlap.T)
+
+def _overlapMatrix(sizeIn,sizeOut):
+	"""
+	  Returns the sizeOut x sizeIn matrix of how much of each output cell (of
+	  unit length) is covered by each input cell, when sizeIn input cells are
+	  stretched over sizeOut output cells.
+	"""
+	# Edges of the input cells, in output cell coordinates
+	edges = np.arange(sizeIn+1)*float(sizeOut)/sizeIn
+	cells = np.arange(sizeOut)[:,np.newaxis]
+	return np.maximum(0,np.minimum(edges[1:],cells+1)-np.maximum(edges[:-1],cells))
+
+def _openTemplates(symbols):
+	"""
+	  Opens the template file for updating, first adding empty templates for
+	  any of the symbols that do not have one yet (only then is the file
+	  rewritten).
+	"""
+	if os.path.exists(TEMPLATEFILE):
+		names, blocks = Templates.read(TEMPLATEFILE,'r+')
+	else:
+		names, blocks = [], Templates.emptyBlocks()
+
+	newNames = [symbol for symbol in symbols if symbol not in names]
+	if len(newNames) > 0:
+		for key in blocks:
+			blocks[key] = np.concatenate((blocks[key],np.zeros([len(newNames),blocks[key].shape[1]])),0)
+		Templates.write(TEMPLATEFILE,names+newNames,blocks)
+		names, blocks = Templates.read(TEMPLATEFILE,'r+')
+	return names, blocks
+
+def _addToStatistics(blocks,feature,index,values):
+	"""
+	  Adds samples (samples x feature size) to the running statistics of one
+	  template.  This takes the same time however many samples the template
+	  already has (Welford's method, in the form that merges two sets of
+	  samples).  Samples without the feature (NaN; see Templates) are skipped.
+	"""
+	values = values[np.all(np.isfinite(values),1)]
+	if len(values) == 0:
+		return
+
+	n = blocks[feature + '_n'][index,0]
+	mu = np.array(blocks[feature + '_mu'][index])
+	m2 = np.array(blocks[feature + '_m2'][index])
+
+	nNew = len(values)
+	muNew = np.mean(values,0)
+	m2New = np.sum(np.square(values-muNew),0)
+
+	total = n + nNew
+	delta = muNew - mu
+	m2 = m2 + m2New + np.square(delta)*n*nNew/total
+
+	blocks[feature + '_n'][index,0] = total
+	blocks[feature + '_mu'][index] = mu + delta*nNew/total
+	blocks[feature + '_m2'][index] = m2
+	blocks[feature + '_sigma'][index] = np.sqrt(m2/total)
 
 def train(shape,symbol):
 	"""
-	  This function takes in a shape from the training program, and averages its
-	  density image with the previous stored values for that symbol.
+	  This function takes in a shape from the training program, and adds its
+	  features to the statistics stored for that symbol.  The sample itself is
+	  appended to the sample log.
 	"""
-	# Shape is a set of x/y coordinates:
-	shape = np.array(shape)
-	mnpts = np.amin(shape,0)
-	mxpts = np.amax(shape,0)
-	w = mxpts[0] - mnpts[0] + 1
-	h = mxpts[1] - mnpts[1] + 1
+	# Shape is a set of x/y coordinates (or a Stroke):
+	xProjNorm, yProjNorm, size = projections(shape)
+	sample = np.zeros(1,Templates.SAMPLEDTYPE)
+	sample['symbol'] = symbol
+	sample['xproj'] = xProjNorm
+	sample['yproj'] = yProjNorm
+	sample['size'] = size
+	sample['density'] = densityGrid(shape)
 
-	# Transform into a binary image
-	shapeBinary = np.zeros([h,w],int)
-	for i in range(np.size(shape,0)):
-		shapeBinary[shape[i,1]-mnpts[1],shape[i,0]-mnpts[0]] = 1
+	Templates.appendSamples(SAMPLEFILE,sample)
 
-	xProj = np.sum(shapeBinary,0)
-	yProj = np.sum(shapeBinary,1)
-	xProjNorm = np.interp(np.linspace(0,1,101),np.linspace(0,1,w),xProj)
-	yProjNorm = np.interp(np.linspace(0,1,101),np.linspace(0,1,h),yProj)
-	xProjNorm = np.reshape(xProjNorm,[1,101])
-	yProjNorm = np.reshape(yProjNorm,[1,101])
-
-	# Load previous data from file
-	name = symbol
-
-	try:
-		prev_xProj = np.load('symbols/' + name + '-xproj.npy')
-		prev_yProj = np.load('symbols/' + name + '-yproj.npy')
-		prev_size = np.load('symbols/' + name + '-size.npy')
-	except:
-		prev_xProj = np.zeros([0,101])
-		prev_yProj = np.zeros([0,101])
-		prev_size = np.zeros([0,2])
-
-	xProj = np.concatenate((prev_xProj,xProjNorm),0)
-	yProj = np.concatenate((prev_yProj,yProjNorm),0)
-	new_size = np.concatenate((prev_size,[[h,w]]),0)
-
-	# These files contain all the past data
-	np.save('symbols/' + name + '-xproj',xProj)
-	np.save('symbols/' + name + '-yproj',yProj)
-	np.save('symbols/' + name + '-size',new_size)
-
-	# These files just contain aggregate data for classification
-	np.save('symbols/' + name + '-xproj_mu_sigma',np.concatenate(([np.mean(xProj,0)],[np.std(xProj,0)]),0))
-	np.save('symbols/' + name + '-yproj_mu_sigma',np.concatenate(([np.mean(yProj,0)],[np.std(yProj,0)]),0))
-	np.save('symbols/' + name + '-size_mu_sigma',np.concatenate(([np.mean(new_size,0)],[np.std(new_size,0)]),0))
+	names, blocks = _openTemplates([symbol])
+	index = names.index(symbol)
+	for feature, featureSize in Templates.FEATURES:
+		_addToStatistics(blocks,feature,index,sample[feature])
+	Templates.sync(TEMPLATEFILE,blocks)
+
+	# Make sure classification picks up the new statistics
+	templateBank.refresh()
+
+def retrain(samples):
+	"""
+	  Rebuilds the templates of every symbol that appears in samples (an array
+	  of Templates.SAMPLEDTYPE records) from those samples alone, in a single
+	  pass.  The sample log is rewritten so that it matches the new templates.
+	"""
+	symbols = []
+	for symbol in samples['symbol']:
+		if symbol not in symbols:
+			symbols.append(symbol)
+
+	names, blocks = _openTemplates(symbols)
+	for symbol in symbols:
+		index = names.index(symbol)
+		symbolSamples = samples[samples['symbol'] == symbol]
+		for feature, featureSize in Templates.FEATURES:
+			for stat in ['n','mu','sigma','m2']:
+				blocks[feature + '_' + stat][index] = 0
+			_addToStatistics(blocks,feature,index,symbolSamples[feature])
+	Templates.sync(TEMPLATEFILE,blocks)
+
+	if os.path.exists(SAMPLEFILE):
+		oldSamples = Templates.readSamples(SAMPLEFILE)
+		oldSamples = oldSamples[np.logical_not(np.in1d(oldSamples['symbol'],symbols))]
+		samples = np.concatenate((oldSamples,samples))
+	Templates.writeSamples(SAMPLEFILE,samples)
+
+	# Make sure classification picks up the new statistics
+	templateBank.refresh()
@@ -0,0 +1,319 @@
+# This file is dedicated to storing the symbol templates.  Rather than a set of
+# small files per symbol, every template is packed into a single file, which is
+# memory-mapped when it is read.  That way loading the templates costs the same
+# however many symbols there are, and processes that read the same file share
+# a single copy of it.
+#
+# The template file layout is:
+#   magic ('SPTB'), format version and header length (little-endian uint32s)
+#   header: JSON with the symbol names, and the offset (in elements from the
+#           start of the data) and shape of each block of data
+#   data: the blocks, as little-endian float64s
+#
+# For each feature, there are blocks with the statistics of every symbol,
+# stacked as symbols x feature size (the density grid is stored flattened):
+#   <feature>_n: the number of training samples (symbols x 1)
+#   <feature>_mu, <feature>_sigma: the mean and standard deviation
+#   <feature>_m2: the sum of squared differences from the mean, which lets the
+#                 statistics be updated one sample at a time (Welford's method)
+#
+# The training samples themselves are appended to a separate sample log, which
+# has the same kind of magic/version/header prefix (the header holds the record
+# layout), followed by fixed size records of the symbol name and its features.
+#
+# Files written before a feature was added are upgraded when they are next
+# written to.  Until then, templates have no statistics for the feature (n is
+# zero), and samples have NaN in place of it, since it cannot be recomputed
+# without the original points.
+
+import os
+import json
+import struct
+import numpy as np
+
+MAGIC = 'SPTB'
+VERSION = 2
+SAMPLEMAGIC = 'SPSL'
+SAMPLEVERSION = 1
+DTYPE = np.dtype('<f8')
+_PREFIX = struct.Struct('<4sII')
+
+# The size of the density grid (rows, columns) that shapes are reduced to
+DENSITYSIZE = (10,10)
+
+# The features stored for each symbol, and their sizes
+FEATURES = [('xproj',101),('yproj',101),('size',2),('density',DENSITYSIZE[0]*DENSITYSIZE[1])]
+
+# The layout of a sample log record
+SAMPLEDTYPE = np.dtype([('symbol','S16')] + [(feature,DTYPE,(size,)) for feature, size in FEATURES])
+
+def _readPrefix(f,magic):
+	fileMagic, version, headerLength = _PREFIX.unpack(f.read(_PREFIX.size))
+	if fileMagic != magic:
+		raise IOError(f.name + ' is not a ' + magic + ' file')
+	header = json.loads(f.read(headerLength).decode('utf-8'))
+	return version, header, _PREFIX.size + headerLength
+
+def _writePrefix(f,magic,version,header):
+	header = json.dumps(header).encode('utf-8')
+	# Pad the header so that the data starts on an 8 byte boundary
+	header += b' '*(-(_PREFIX.size+len(header)) % DTYPE.itemsize)
+	f.write(_PREFIX.pack(magic,version,len(header)))
+	f.write(header)
+
+def _read(path,mode):
+	f = open(path,'rb')
+	try:
+		version, header, dataOffset = _readPrefix(f,MAGIC)
+	finally:
+		f.close()
+
+	dataSize = header['size']
+	if dataSize > 0:
+		data = np.memmap(path,dtype=DTYPE,mode=mode,offset=dataOffset,shape=(dataSize,))
+	else:
+		data = np.zeros(0,DTYPE)
+
+	blocks = {}
+	for key, (offset, shape) in header['blocks'].items():
+		count = int(np.prod(shape))
+		blocks[str(key)] = data[offset:offset+count].reshape(shape)
+	return version, [str(name) for name in header['symbols']], blocks
+
+def read(path,mode='r'):
+	"""
+	  Reads a template file, returning the list of symbol names and a
+	  dictionary of its blocks.  The blocks are views into a memory map of the
+	  file, so nothing is copied; they are read-only unless mode is 'r+', in
+	  which case changes to them are written to the file (see sync).
+	"""
+	version, names, blocks = _read(path,mode)
+	if version != VERSION:
+		raise IOError(path + ' is an old template file; run Templates.py to convert it')
+
+	# Files written before a feature was added have no statistics for it
+	missing = dict((key,block) for key, block in emptyBlocks(len(names)).items() if key not in blocks)
+	if len(missing) > 0:
+		blocks.update(missing)
+		if mode == 'r+':
+			# Add the new blocks to the file, so that changes to them are kept
+			write(path,names,blocks)
+			return read(path,mode)
+	return names, blocks
+
+def sync(path,blocks):
+	"""
+	  Writes changes made to blocks read with mode 'r+' to the file, and
+	  updates its modification time so that other template banks reload it.
+	"""
+	for block in blocks.values():
+		if isinstance(block,np.memmap):
+			block.flush()
+			break
+	os.utime(path,None)
+
+def emptyBlocks(count=0):
+	"""
+	  Returns the blocks of a template file with count symbols, none of which
+	  have any samples.
+	"""
+	blocks = {}
+	for feature, size in FEATURES:
+		blocks[feature + '_n'] = np.zeros([count,1])
+		for stat in ['mu','sigma','m2']:
+			blocks[feature + '_' + stat] = np.zeros([count,size])
+	return blocks
+
+def write(path,names,blocks):
+	"""
+	  Writes the symbol names and blocks to a template file.  The new file is
+	  written next to the old one and then moved over it, so that readers
+	  (including memory maps of the old file) never see a partial file.
+	"""
+	index = {}
+	offset = 0
+	keys = sorted(blocks.keys())
+	for key in keys:
+		shape = list(np.shape(blocks[key]))
+		index[key] = [offset,shape]
+		offset += int(np.prod(shape))
+
+	tempPath = path + '.tmp'
+	f = open(tempPath,'wb')
+	try:
+		_writePrefix(f,MAGIC,VERSION,{'symbols':list(names),'size':offset,'blocks':index})
+		for key in keys:
+			f.write(np.ascontiguousarray(blocks[key],DTYPE).tostring())
+	finally:
+		f.close()
+	os.rename(tempPath,path)
+
+def _writeSamplePrefix(path):
+	f = open(path,'wb')
+	try:
+		_writePrefix(f,SAMPLEMAGIC,SAMPLEVERSION,{'descr':SAMPLEDTYPE.descr})
+	finally:
+		f.close()
+
+def _readSamplePrefix(path):
+	"""
+	  Returns the record layout of a sample log, and where its records start.
+	"""
+	f = open(path,'rb')
+	try:
+		version, header, dataOffset = _readPrefix(f,SAMPLEMAGIC)
+	finally:
+		f.close()
+	# JSON turns the tuples of the layout into lists
+	fields = []
+	for field in header['descr']:
+		field = [str(part) if isinstance(part,basestring) else part for part in field]
+		if len(field) == 3:
+			field[2] = tuple(field[2])
+		fields.append(tuple(field))
+	return np.dtype(fields), dataOffset
+
+def _upgradeSamples(samples):
+	"""
+	  Converts records with an older layout to SAMPLEDTYPE.  Features that the
+	  samples were recorded without are NaN.
+	"""
+	upgraded = np.zeros(len(samples),SAMPLEDTYPE)
+	for name in SAMPLEDTYPE.names:
+		if name in samples.dtype.names:
+			upgraded[name] = samples[name]
+		else:
+			upgraded[name] = np.nan
+	return upgraded
+
+def appendSamples(path,samples):
+	"""
+	  Appends records (an array of SAMPLEDTYPE) to the sample log, creating it
+	  if necessary.  Nothing that is already in the log is read or rewritten,
+	  unless it has an older layout (then the whole log is upgraded first).
+	"""
+	if not os.path.exists(path):
+		_writeSamplePrefix(path)
+	elif _readSamplePrefix(path)[0] != SAMPLEDTYPE:
+		writeSamples(path,readSamples(path))
+	f = open(path,'ab')
+	try:
+		f.write(np.asarray(samples,SAMPLEDTYPE).tostring())
+	finally:
+		f.close()
+
+def writeSamples(path,samples):
+	"""
+	  Replaces the sample log with the given records.  As with template files,
+	  the new log is written next to the old one and then moved over it.
+	"""
+	tempPath = path + '.tmp'
+	_writeSamplePrefix(tempPath)
+	appendSamples(tempPath,samples)
+	os.rename(tempPath,path)
+
+def readSamples(path):
+	"""
+	  Returns every record in the sample log, as a read-only memory-mapped
+	  array of SAMPLEDTYPE (or, if the log has an older layout, an upgraded
+	  copy of it).
+	"""
+	dtype, dataOffset = _readSamplePrefix(path)
+	count = (os.path.getsize(path) - dataOffset) // dtype.itemsize
+	if count == 0:
+		return np.zeros(0,SAMPLEDTYPE)
+	samples = np.memmap(path,dtype=dtype,mode='r',offset=dataOffset,shape=(count,))
+	if dtype != SAMPLEDTYPE:
+		return _upgradeSamples(samples)
+	return samples
+
+def pack(path,samplePath,names,histories,stats=None):
+	"""
+	  Builds a template file and sample log from each symbol's history (a
+	  dictionary of samples x feature size arrays, keyed by feature).  The
+	  statistics are computed from the history, unless they are given (as a
+	  dictionary of (mu,sigma) pairs keyed by symbol and feature).  Features
+	  missing from the history are left without statistics.
+	"""
+	blocks = emptyBlocks()
+	for feature, size in FEATURES:
+		rows = dict((stat,[]) for stat in ['n','mu','sigma','m2'])
+		for name in names:
+			history = histories[name].get(feature)
+			if history is None:
+				history = np.zeros([0,size])
+				mu = sigma = np.zeros(size)
+			elif stats is None:
+				mu = np.mean(history,0)
+				sigma = np.std(history,0)
+			else:
+				mu, sigma = stats[name][feature]
+			n = len(history)
+			rows['n'].append([n])
+			rows['mu'].append(mu)
+			rows['sigma'].append(np.abs(sigma))
+			rows['m2'].append(n*np.square(sigma))
+		for stat in rows:
+			blocks[feature + '_' + stat] = np.reshape(rows[stat],[len(names),-1])
+	write(path,names,blocks)
+
+	samples = []
+	for name in names:
+		symbolSamples = np.zeros(len(histories[name][FEATURES[0][0]]),SAMPLEDTYPE)
+		symbolSamples['symbol'] = name
+		for feature, size in FEATURES:
+			symbolSamples[feature] = histories[name].get(feature,np.nan)
+		samples.append(symbolSamples)
+	writeSamples(samplePath,np.concatenate(samples))
+
+def convertLegacy(directory,path,samplePath,names):
+	"""
+	  Converts the templates of the given symbols from the older storage
+	  formats: either a version 1 template file (with the history stored in
+	  it), or the per-symbol .npy files (<symbol>-<feature>.npy for the history
+	  and <symbol>-<feature>_mu_sigma.npy for the statistics).
+	"""
+	# The older formats have no density grids
+	features = [feature for feature in FEATURES if feature[0] != 'density']
+
+	histories = {}
+	stats = {}
+	if os.path.exists(path):
+		version, fileNames, blocks = _read(path,'r')
+		if version != 1:
+			raise IOError(path + ' is already up to date')
+		names = fileNames
+		for i in range(len(names)):
+			histories[names[i]] = {}
+			stats[names[i]] = {}
+			for feature, size in features:
+				histories[names[i]][feature] = np.array(blocks[names[i] + '-' + feature])
+				stats[names[i]][feature] = (blocks[feature + '_mu'][i],blocks[feature + '_sigma'][i])
+	else:
+		for name in names:
+			histories[name] = {}
+			stats[name] = {}
+			for feature, size in features:
+				base = os.path.join(directory,name + '-' + feature)
+				muSigma = np.load(base + '_mu_sigma.npy')
+				stats[name][feature] = (muSigma[0],muSigma[1])
+				try:
+					histories[name][feature] = np.load(base + '.npy')
+				except IOError:
+					histories[name][feature] = np.zeros([0,size])
+	pack(path,samplePath,names,histories,stats)
+
+if __name__ == '__main__':
+	import glob
+	import Symbols
+
+	# Convert the templates used by the classifier first (in order), followed
+	# by any other symbols that have been trained.
+	directory = os.path.dirname(Symbols.TEMPLATEFILE)
+	names = list(Symbols.templates)
+	for statsFile in sorted(glob.glob(os.path.join(directory,'*-size_mu_sigma.npy'))):
+		name = os.path.basename(statsFile)[:-len('-size_mu_sigma.npy')]
+		if name not in names:
+			names.append(name)
+	convertLegacy(directory,Symbols.TEMPLATEFILE,Symbols.SAMPLEFILE,names)
+	print 'Converted the templates in ' + directory
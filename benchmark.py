@@ -0,0 +1,348 @@
+"""
+This file benchmarks the speed and accuracy of the classifier on synthetic
+strokes, and the speed of saving and loading synthetic documents, so that
+changes can be compared against earlier runs before they are deployed.
+
+Results are written as JSON, and can be compared against the results of a
+previous run; regressions are reported, and make the script exit with an error.
+"""
+
+import os
+import gc
+import sys
+import json
+import tempfile
+import resource
+import argparse
+import numpy as np
+from timeit import default_timer as timer
+import Symbols
+import Documents
+from Pages import Page, HeadlessPad
+from MusicObjects import STAFFSPACING
+
+# Strokes are built from segments (pen down to pen up) of control points, in
+# pixels at a unit scale.  Curves are described by enough control points that
+# joining them with straight lines looks right.
+def _arc(cx,cy,rx,ry,start,end,n=24):
+	angles = np.linspace(start,end,n)
+	return list(zip(cx+rx*np.cos(angles),cy+ry*np.sin(angles)))
+
+def _spiral(cx,cy,r,turns,n=60):
+	t = np.linspace(0,1,n)
+	angles = 2*np.pi*turns*t
+	return list(zip(cx+r*t*np.cos(angles),cy+r*t*np.sin(angles)))
+
+SHAPES = {
+	'dot': [_spiral(7,7,7,5)],
+	'circle': [_arc(8,8,8,8,0,2*np.pi)],
+	'flat': [[(0,0),(0,32)] + _arc(3,26,6,6,np.pi/2,-np.pi,12)[1:]],
+	'sharp': [[(7,0),(7,26)],[(14,1),(14,27)],[(0,10),(21,6)],[(0,20),(21,16)]],
+	'natural': [[(0,0),(0,27),(12,23)],[(0,12),(12,8),(12,37)]],
+	'hat': [[(0,12),(7,0),(14,12)]],
+	'sm_dot': [_arc(1.3,1.3,1.3,1.3,0,4*np.pi,12)],
+	'hline': [[(0,0),(40,0)]],
+	'vline': [[(0,0),(0,40)]],
+	'lline': [[(0,0),(28,28)]],
+	'rline': [[(28,0),(0,28)]],
+}
+
+# Every symbol that the generator can draw (the templates, and the lines)
+SYMBOLS = Symbols.templates + ['hline','vline','lline','rline']
+
+def generateStroke(symbol,scale=1.0,jitter=0.5,density=0.5,rng=np.random):
+	"""
+	  Returns the points of a synthetic stroke for the given symbol, as they
+	  would be captured from the pen: integer screen coordinates, spaced about
+	  1/density pixels apart along the path, with normally distributed jitter
+	  (of the given standard deviation, in pixels) added to each point.
+	"""
+	offset = rng.uniform(50,150,2)
+	points = []
+	for segment in SHAPES[symbol]:
+		segment = np.array(segment,float)*scale
+		for i in range(len(segment)-1):
+			length = np.sqrt(np.sum(np.square(segment[i+1]-segment[i])))
+			steps = max(1,int(np.ceil(length*density)))
+			t = np.linspace(0,1,steps,endpoint=False)[:,np.newaxis]
+			points.extend(segment[i] + t*(segment[i+1]-segment[i]))
+		points.append(segment[-1])
+
+	points = np.round(np.array(points) + offset + rng.normal(0,jitter,[len(points),2])).astype(int)
+
+	# The pen only records a point when it moves
+	keep = np.concatenate(([True],np.any(points[1:] != points[:-1],1)))
+	return points[keep].tolist()
+
+def generateStrokes(count,scale=1.0,jitter=0.5,density=0.5,seed=0):
+	"""
+	  Returns count strokes of each symbol (in a random order), along with the
+	  symbol each stroke is a drawing of.  The scale of each stroke varies by
+	  up to 10% around the given scale.
+	"""
+	rng = np.random.RandomState(seed)
+	labels = [symbol for symbol in SYMBOLS for i in range(count)]
+	rng.shuffle(labels)
+	strokes = [generateStroke(label,scale*rng.uniform(0.9,1.1),jitter,density,rng) for label in labels]
+	return strokes, labels
+
+def _peakMemory():
+	"""
+	  Peak resident memory of this process, in kilobytes.
+	"""
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _latencies(classify,strokes):
+	results = []
+	times = np.zeros(len(strokes))
+	for i in range(len(strokes)):
+		start = timer()
+		results.append(classify(strokes[i]))
+		times[i] = timer()-start
+	return results, times
+
+def _confusion(labels,results):
+	confusion = {}
+	for label, result in zip(labels,results):
+		row = confusion.setdefault(label,{})
+		row[result] = row.get(result,0) + 1
+	return confusion
+
+# The ways of classifying a stroke that are timed
+MODES = {
+	'classify': lambda stroke: Symbols.classify(stroke),
+	'cascade': lambda stroke: Symbols.classify(stroke,cascade=True),
+	'density': lambda stroke: Symbols.classify(stroke,method='density'),
+	'knn': lambda stroke: Symbols.classify(stroke,method='knn'),
+}
+
+def benchmarkClassifier(options):
+	"""
+	  Times classify for each mode on individual strokes (latency), and
+	  classify_batch on all of them (throughput), and measures how accurately
+	  the strokes are classified.
+	"""
+	strokes, labels = generateStrokes(options.count,options.scale,options.jitter,options.density,options.seed)
+
+	# Load the templates before timing anything
+	Symbols.templateBank.current()
+	memoryBefore = _peakMemory()
+
+	results = {}
+	for mode in sorted(MODES):
+		symbols, times = _latencies(MODES[mode],strokes)
+		results[mode] = {
+			'latency_p50_ms': 1000*np.percentile(times,50),
+			'latency_p90_ms': 1000*np.percentile(times,90),
+			'latency_p99_ms': 1000*np.percentile(times,99),
+			'throughput_per_s': len(strokes)/np.sum(times),
+			'accuracy': np.mean([symbol == label for symbol, label in zip(symbols,labels)]),
+			'confusion': _confusion(labels,symbols),
+		}
+
+	# Classify the strokes a second time with the result cache on, as when a
+	# session is replayed
+	cacheSize = Symbols.resultCache.size
+	Symbols.resultCache.resize(len(strokes))
+	try:
+		_latencies(MODES['classify'],strokes)
+		Symbols.resultCache.resetCounters()
+		symbols, times = _latencies(MODES['classify'],strokes)
+		results['replay'] = {
+			'latency_p50_ms': 1000*np.percentile(times,50),
+			'latency_p99_ms': 1000*np.percentile(times,99),
+			'throughput_per_s': len(strokes)/np.sum(times),
+			'cache_hit_rate': Symbols.resultCache.hitRate(),
+		}
+	finally:
+		Symbols.resultCache.clear()
+		Symbols.resultCache.resize(cacheSize)
+
+	start = timer()
+	symbols = Symbols.classify_batch(strokes)
+	elapsed = timer()-start
+	results['classify_batch'] = {
+		'throughput_per_s': len(strokes)/elapsed,
+		'accuracy': np.mean([symbol == label for symbol, label in zip(symbols,labels)]),
+	}
+
+	results['memory'] = {
+		'peak_rss_kb': _peakMemory(),
+		'peak_rss_growth_kb': _peakMemory()-memoryBefore,
+	}
+	return results
+
+def generatePage(pad,columns=14,rng=np.random):
+	"""
+	  Returns a synthetic page of music, built by adding shapes to it as they
+	  would be drawn: on each staff, columns of one to four notes, some with
+	  accidentals or dots and most with stems, with a barline after every
+	  fourth column.
+	"""
+	page = Page(pad)
+	for staff in list(page.staves):
+		y = staff._yMiddle
+		for column in range(columns):
+			x = 40 + 32*column
+			if column % 5 == 4:
+				page.addObject('vline',[[x,y-30],[x+1,y+30]])
+				continue
+			lines = rng.choice(np.arange(-4,5),rng.randint(1,5),replace=False)
+			for line in lines:
+				noteY = y + STAFFSPACING/2.0*line
+				page.addObject(rng.choice(['dot','circle']),[[x-7,noteY-7],[x+7,noteY+7]])
+			noteY = y + STAFFSPACING/2.0*lines[0]
+			if rng.rand() < 0.3:
+				page.addObject(rng.choice(['sharp','flat','natural']),[[x-27,noteY-10],[x-18,noteY+10]])
+			if rng.rand() < 0.2:
+				page.addObject('sm_dot',[[x+14,noteY-1],[x+16,noteY+1]])
+			if rng.rand() < 0.7:
+				top = y + STAFFSPACING/2.0*np.min(lines) - 2*STAFFSPACING
+				bottom = y + STAFFSPACING/2.0*np.max(lines)
+				page.addObject('vline',[[x+7,top],[x+8,bottom]])
+	return page
+
+def benchmarkLoad(options):
+	"""
+	  Times saving a synthetic pad of options.pages pages to a document, and
+	  loading it back: every page in order, and single pages picked at random.
+	  Building the pages shape by shape is timed too, for comparison.
+	"""
+	rng = np.random.RandomState(options.seed)
+	pad = HeadlessPad()
+	start = timer()
+	pages = [generatePage(pad,rng=rng) for i in range(options.pages)]
+	buildTime = timer()-start
+	objects = sum(len(page.getObjects()) for page in pages)
+
+	handle, path = tempfile.mkstemp('.sppd')
+	os.close(handle)
+	try:
+		start = timer()
+		Documents.write(path,pages,pad.pageSize)
+		saveTime = timer()-start
+		size = os.path.getsize(path)
+		# (The objects have reference cycles, so they are only freed by a
+		# collection, which is done here rather than while anything is timed)
+		del pages
+		gc.collect()
+
+		memoryBefore = _peakMemory()
+		start = timer()
+		pages = Documents.read(path,pad)
+		loadTime = timer()-start
+		gc.collect()
+
+		numbers = rng.randint(0,options.pages,min(options.pages,100))
+		times = np.zeros(len(numbers))
+		for i in range(len(numbers)):
+			start = timer()
+			Documents.readPage(path,numbers[i],pad)
+			times[i] = timer()-start
+	finally:
+		os.remove(path)
+
+	return {
+		'build': {
+			'latency_per_page_ms': 1000*buildTime/options.pages,
+			'objects_per_page': float(objects)/options.pages,
+		},
+		'save': {
+			'latency_ms': 1000*saveTime,
+			'throughput_pages_per_s': options.pages/saveTime,
+			'bytes_per_page': float(size)/options.pages,
+		},
+		'load': {
+			'latency_ms': 1000*loadTime,
+			'throughput_pages_per_s': options.pages/loadTime,
+		},
+		'load_page': {
+			'latency_p50_ms': 1000*np.percentile(times,50),
+			'latency_p99_ms': 1000*np.percentile(times,99),
+		},
+		'memory': {
+			'peak_rss_kb': _peakMemory(),
+			'peak_rss_growth_kb': _peakMemory()-memoryBefore,
+		},
+	}
+
+SUITES = {
+	'classify': benchmarkClassifier,
+	'load': benchmarkLoad,
+}
+
+# How each kind of metric regresses (higher or lower is worse)
+def _isWorse(metric,old,new,tolerance):
+	if metric.startswith('latency') or metric.startswith('peak_rss') or metric.startswith('bytes'):
+		return new > old*(1+tolerance)
+	if metric.startswith('throughput'):
+		return new < old*(1-tolerance)
+	if metric == 'accuracy':
+		return new < old-0.01
+	return False
+
+def compare(old,new,tolerance):
+	"""
+	  Prints the metrics of two runs side by side, and returns the list of
+	  metrics that got worse by more than the tolerance (a fraction).
+	"""
+	regressions = []
+	for suite in sorted(new['results']):
+		for group in sorted(new['results'][suite]):
+			for metric, value in sorted(new['results'][suite][group].items()):
+				try:
+					oldValue = old['results'][suite][group][metric]
+				except KeyError:
+					continue
+				if isinstance(value,dict):
+					continue
+				name = suite + '.' + group + '.' + metric
+				flag = ''
+				if _isWorse(metric,oldValue,value,tolerance):
+					regressions.append(name)
+					flag = '  <-- REGRESSION'
+				print '%-50s %12.4g %12.4g%s' % (name,oldValue,value,flag)
+	return regressions
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Benchmark the StaffPad classifier and documents.')
+	parser.add_argument('suites',nargs='*',default=sorted(SUITES),help='suites to run: ' + ', '.join(sorted(SUITES)))
+	parser.add_argument('--count',type=int,default=200,help='strokes per symbol')
+	parser.add_argument('--scale',type=float,default=1.0,help='size of the strokes')
+	parser.add_argument('--jitter',type=float,default=0.5,help='standard deviation of the point noise, in pixels')
+	parser.add_argument('--density',type=float,default=0.5,help='points per pixel along the stroke')
+	parser.add_argument('--pages',type=int,default=500,help='pages in the synthetic documents')
+	parser.add_argument('--seed',type=int,default=0)
+	parser.add_argument('--output',help='file to write the results to (JSON)')
+	parser.add_argument('--compare',help='results of an earlier run to compare against')
+	parser.add_argument('--tolerance',type=float,default=0.2,help='allowed slowdown before a metric counts as a regression')
+	options = parser.parse_args(argv)
+
+	run = {'options':vars(options),'results':{}}
+	for suite in options.suites:
+		run['results'][suite] = SUITES[suite](options)
+
+	text = json.dumps(run,indent=1,sort_keys=True)
+	if options.output:
+		f = open(options.output,'w')
+		try:
+			f.write(text)
+		finally:
+			f.close()
+	else:
+		print text
+
+	if options.compare:
+		f = open(options.compare)
+		try:
+			old = json.load(f)
+		finally:
+			f.close()
+		regressions = compare(old,run,options.tolerance)
+		if regressions:
+			print str(len(regressions)) + ' regression(s)'
+			return 1
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,440 @@
+"""
+This file is a stroke recognition server, so that several tablets can share
+one machine's classifier.  Strokes are classified in batches by a pool of
+worker processes, which all share the (memory-mapped) template bank.
+
+Clients connect over a local TCP port or Unix socket, and send one JSON object
+per line:
+  {"id": <anything>, "points": [[x,y], ...], "page": <anything>}
+and get one JSON object per line back:
+  {"id": ..., "symbol": "dot", "score": 0.83, "page": ...}
+The id and page context are returned unchanged, so that the client can match
+results to strokes.  When the server is overloaded, the reply is
+  {"id": ..., "error": "busy"}
+strokes whose points are not a list of [x,y] pairs of finite numbers, or that
+are more than MAXSTROKESIZE across, get
+  {"id": ..., "error": "invalid points"}
+and strokes that aren't classified within REQUESTTIMEOUT seconds (if their
+worker died, say) get
+  {"id": ..., "error": "timed out"}
+Sending {"stats": true} returns the server's throughput and latency report.
+
+Run the server with
+   python server.py [--port PORT | --socket PATH] [--processes N]
+and measure it (from another terminal) with
+   python server.py --load-test CLIENTS [--count STROKES] [--port PORT | --socket PATH]
+"""
+
+import sys
+import os
+import json
+import math
+import socket
+import signal
+import argparse
+import threading
+import multiprocessing
+import SocketServer
+import Queue
+import numpy as np
+from collections import deque
+from timeit import default_timer as timer
+import Symbols
+
+# TODO: put these into config file
+# Strokes that can wait to be classified before new ones are turned away
+QUEUESIZE = 1024
+# Seconds a stroke waits for room in the queue before it is turned away
+QUEUETIMEOUT = 0.5
+# Maximum number of strokes sent to a worker at once
+BATCHSIZE = 64
+# Seconds to wait for more strokes to fill a batch
+BATCHWAIT = 0.002
+# Seconds a batch may take to be classified before it is given up on (the pool
+# never answers for a batch whose worker died)
+BATCHTIMEOUT = 10.0
+# Seconds a client waits for its stroke to be classified
+REQUESTTIMEOUT = 30.0
+# Largest width or height of a stroke (the classifier's memory use grows with
+# a stroke's extent)
+MAXSTROKESIZE = 10000
+# Number of recent requests that latency percentiles are computed over
+LATENCYHISTORY = 10000
+# Seconds between reports
+REPORTINTERVAL = 10.0
+
+DEFAULTPORT = 5757
+
+def _initWorker():
+	# Interrupts are handled by the server, which shuts the workers down
+	signal.signal(signal.SIGINT,signal.SIG_IGN)
+	# Load the templates before any strokes arrive
+	Symbols.templateBank.current()
+
+def _classifyBatch(shapes):
+	"""
+	  Runs in the worker processes.  Returns the symbol, score and error (or
+	  None) of each stroke.  Errors are returned rather than raised, so that
+	  the strokes waiting on the batch are always answered, and if the batch
+	  fails, its strokes are classified one at a time, so that only the ones
+	  that fail get an error.
+	"""
+	try:
+		symbols, scores = Symbols.classify_batch(shapes,returnScores=True)
+		return symbols, scores, [None]*len(shapes)
+	except Exception:
+		pass
+
+	symbols = [None]*len(shapes)
+	scores = [None]*len(shapes)
+	errors = [None]*len(shapes)
+	for i in range(len(shapes)):
+		try:
+			[symbols[i]], [scores[i]] = Symbols.classify_batch([shapes[i]],returnScores=True)
+		except Exception, e:
+			errors[i] = str(e)
+	return symbols, scores, errors
+
+def _validPoints(points):
+	"""
+	  Whether a request's points are a non-empty list of [x,y] pairs of
+	  finite numbers, no more than MAXSTROKESIZE across.
+	"""
+	if not isinstance(points,list) or len(points) == 0:
+		return False
+	for point in points:
+		if not isinstance(point,list) or len(point) != 2:
+			return False
+		for value in point:
+			if isinstance(value,bool) or not isinstance(value,(int,long,float)):
+				return False
+			if math.isinf(value) or math.isnan(value):
+				return False
+	xs = [point[0] for point in points]
+	ys = [point[1] for point in points]
+	return max(xs)-min(xs) <= MAXSTROKESIZE and max(ys)-min(ys) <= MAXSTROKESIZE
+
+class Statistics:
+	"""
+	  Counts requests, and keeps the latencies of recent ones, for reports.
+	"""
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.started = timer()
+		self.received = 0
+		self.completed = 0
+		self.rejected = 0
+		self.lost = 0
+		self.batches = 0
+		self._latencies = deque(maxlen=LATENCYHISTORY)
+
+	def recordRejected(self):
+		with self._lock:
+			self.received += 1
+			self.rejected += 1
+
+	def recordLost(self,count):
+		with self._lock:
+			self.received += count
+			self.lost += count
+
+	def recordBatch(self,latencies):
+		with self._lock:
+			self.received += len(latencies)
+			self.completed += len(latencies)
+			self.batches += 1
+			self._latencies.extend(latencies)
+
+	def report(self,queueDepth=0):
+		with self._lock:
+			elapsed = timer()-self.started
+			report = {
+				'uptime_s': elapsed,
+				'received': self.received,
+				'completed': self.completed,
+				'rejected': self.rejected,
+				'lost': self.lost,
+				'queue_depth': queueDepth,
+				'throughput_per_s': self.completed/elapsed,
+				'mean_batch_size': self.completed/float(max(self.batches,1)),
+			}
+			if len(self._latencies) > 0:
+				latencies = 1000*np.array(self._latencies)
+				report['latency_p50_ms'] = np.percentile(latencies,50)
+				report['latency_p90_ms'] = np.percentile(latencies,90)
+				report['latency_p99_ms'] = np.percentile(latencies,99)
+		return report
+
+class _Job:
+	def __init__(self,points):
+		self.points = points
+		self.received = timer()
+		self.done = threading.Event()
+		self.symbol = None
+		self.score = None
+		self.error = None
+
+class Recognizer:
+	"""
+	  Queues strokes, and classifies them in batches on a pool of worker
+	  processes.  The queue is bounded, and only a couple of batches per worker
+	  are handed to the pool at once, so when strokes arrive faster than they
+	  can be classified they wait in the queue, and once it is full new ones
+	  are turned away (see submit).  Batches that the pool hasn't answered
+	  within BATCHTIMEOUT seconds are given up on (see _expireBatches).
+	"""
+	def __init__(self,processes=None):
+		self.stats = Statistics()
+		self._queue = Queue.Queue(QUEUESIZE)
+		self._pool = multiprocessing.Pool(processes,_initWorker)
+		self._slots = threading.Semaphore(2*(processes or multiprocessing.cpu_count()))
+		# The batches handed to the pool and not yet answered, by number, with
+		# the time they were handed over
+		self._pending = {}
+		self._pendingLock = threading.Lock()
+		self._batchNumber = 0
+		self._closed = threading.Event()
+		self._dispatcher = threading.Thread(target=self._dispatch)
+		self._dispatcher.daemon = True
+		self._dispatcher.start()
+		self._expirer = threading.Thread(target=self._expireBatches)
+		self._expirer.daemon = True
+		self._expirer.start()
+
+	def submit(self,points):
+		"""
+		  Queues a stroke, and returns a job to wait on (job.done), or None if
+		  the queue stayed full for QUEUETIMEOUT seconds.
+		"""
+		job = _Job(points)
+		try:
+			self._queue.put(job,True,QUEUETIMEOUT)
+		except Queue.Full:
+			self.stats.recordRejected()
+			return None
+		return job
+
+	def queueDepth(self):
+		return self._queue.qsize()
+
+	def close(self):
+		self._closed.set()
+		self._pool.terminate()
+
+	def _dispatch(self):
+		while True:
+			batch = [self._queue.get()]
+			# Wait a moment for more strokes, so that they share a batch
+			deadline = timer()+BATCHWAIT
+			while len(batch) < BATCHSIZE:
+				try:
+					batch.append(self._queue.get(True,max(0,deadline-timer())))
+				except Queue.Empty:
+					break
+
+			self._slots.acquire()
+			self._batchNumber += 1
+			with self._pendingLock:
+				self._pending[self._batchNumber] = (batch,timer())
+			self._pool.apply_async(_classifyBatch,([job.points for job in batch],),
+			                       callback=lambda result, number=self._batchNumber: self._finish(number,result))
+
+	def _expireBatches(self):
+		"""
+		  Answers the strokes of batches that have taken more than BATCHTIMEOUT
+		  seconds with an error, and frees their slots.  (If a worker dies,
+		  the pool never calls back for its batch, which would otherwise hold
+		  its slot, and keep its strokes waiting, for good.)
+		"""
+		while not self._closed.wait(BATCHTIMEOUT/10):
+			now = timer()
+			with self._pendingLock:
+				expired = [number for number, (batch, started) in self._pending.items() if now-started > BATCHTIMEOUT]
+				batches = [self._pending.pop(number)[0] for number in expired]
+			for batch in batches:
+				for job in batch:
+					job.error = 'timed out'
+					job.done.set()
+				self.stats.recordLost(len(batch))
+				self._slots.release()
+
+	def _finish(self,number,result):
+		# (The batch may have been given up on already)
+		with self._pendingLock:
+			pending = self._pending.pop(number,None)
+		if pending is None:
+			return
+		batch = pending[0]
+		symbols, scores, errors = result
+		finished = timer()
+		for i in range(len(batch)):
+			if errors[i]:
+				batch[i].error = errors[i]
+			else:
+				batch[i].symbol = symbols[i]
+				batch[i].score = scores[i]
+			batch[i].done.set()
+		self.stats.recordBatch([finished-job.received for job in batch])
+		self._slots.release()
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+	def handle(self):
+		recognizer = self.server.recognizer
+		while True:
+			line = self.rfile.readline()
+			if not line:
+				break
+			if not line.strip():
+				continue
+
+			try:
+				request = json.loads(line)
+			except ValueError:
+				self._reply({'error':'invalid request'})
+				continue
+
+			if request.get('stats'):
+				self._reply(recognizer.stats.report(recognizer.queueDepth()))
+				continue
+
+			response = {'id':request.get('id'),'page':request.get('page')}
+			points = request.get('points')
+			if not points:
+				response['error'] = 'no points'
+				self._reply(response)
+				continue
+			if not _validPoints(points):
+				response['error'] = 'invalid points'
+				self._reply(response)
+				continue
+
+			job = recognizer.submit(points)
+			if job is None:
+				response['error'] = 'busy'
+			else:
+				if not job.done.wait(REQUESTTIMEOUT):
+					response['error'] = 'timed out'
+				elif job.error:
+					response['error'] = job.error
+				else:
+					response['symbol'] = job.symbol
+					response['score'] = job.score
+			self._reply(response)
+
+	def _reply(self,response):
+		self.wfile.write(json.dumps(response) + '\n')
+
+class _TCPServer(SocketServer.ThreadingMixIn,SocketServer.TCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+class _UnixServer(SocketServer.ThreadingMixIn,SocketServer.UnixStreamServer):
+	daemon_threads = True
+
+def serve(recognizer,port=DEFAULTPORT,socketPath=None):
+	"""
+	  Serves requests until interrupted, printing a report every
+	  REPORTINTERVAL seconds (and one at the end).
+	"""
+	if socketPath:
+		if os.path.exists(socketPath):
+			os.remove(socketPath)
+		server = _UnixServer(socketPath,_RequestHandler)
+	else:
+		server = _TCPServer(('127.0.0.1',port),_RequestHandler)
+	server.recognizer = recognizer
+
+	def report():
+		print json.dumps(recognizer.stats.report(recognizer.queueDepth()),sort_keys=True)
+		sys.stdout.flush()
+
+	stopped = threading.Event()
+	def reportPeriodically():
+		while not stopped.wait(REPORTINTERVAL):
+			report()
+	reporter = threading.Thread(target=reportPeriodically)
+	reporter.daemon = True
+	reporter.start()
+
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		stopped.set()
+		reporter.join()
+		server.server_close()
+		report()
+
+def _connect(port,socketPath):
+	if socketPath:
+		connection = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+		connection.connect(socketPath)
+	else:
+		connection = socket.create_connection(('127.0.0.1',port))
+	return connection
+
+def loadTest(clients,count,port=DEFAULTPORT,socketPath=None):
+	"""
+	  Sends synthetic strokes (count of each symbol) from several clients at
+	  once, and returns the throughput and latency they saw.
+	"""
+	import benchmark
+	strokes, labels = benchmark.generateStrokes(count)
+	latencies = []
+	busy = [0]
+	lock = threading.Lock()
+
+	def client(strokes):
+		connection = _connect(port,socketPath)
+		stream = connection.makefile('rw')
+		try:
+			for i in range(len(strokes)):
+				start = timer()
+				stream.write(json.dumps({'id':i,'points':strokes[i]}) + '\n')
+				stream.flush()
+				response = json.loads(stream.readline())
+				with lock:
+					latencies.append(timer()-start)
+					if response.get('error') == 'busy':
+						busy[0] += 1
+		finally:
+			stream.close()
+			connection.close()
+
+	threads = [threading.Thread(target=client,args=(strokes[i::clients],)) for i in range(clients)]
+	start = timer()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	elapsed = timer()-start
+
+	latencies = 1000*np.array(latencies)
+	return {
+		'clients': clients,
+		'strokes': len(latencies),
+		'busy': busy[0],
+		'throughput_per_s': len(latencies)/elapsed,
+		'latency_p50_ms': np.percentile(latencies,50),
+		'latency_p90_ms': np.percentile(latencies,90),
+		'latency_p99_ms': np.percentile(latencies,99),
+	}
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='StaffPad stroke recognition server.')
+	parser.add_argument('--port',type=int,default=DEFAULTPORT,help='local TCP port to listen on')
+	parser.add_argument('--socket',help='Unix socket to listen on (instead of a TCP port)')
+	parser.add_argument('--processes',type=int,help='number of worker processes (default: one per core)')
+	parser.add_argument('--load-test',type=int,metavar='CLIENTS',help='measure a running server with this many clients')
+	parser.add_argument('--count',type=int,default=100,help='strokes of each symbol to send in a load test')
+	options = parser.parse_args()
+
+	if options.load_test:
+		print json.dumps(loadTest(options.load_test,options.count,options.port,options.socket),sort_keys=True)
+	else:
+		recognizer = Recognizer(options.processes)
+		try:
+			serve(recognizer,options.port,options.socket)
+		finally:
+			recognizer.close()
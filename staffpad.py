@@ -1,12 +1,17 @@
+import os
+import sys
 import pygame
+import threading
+import traceback
+import Queue
 from numpy import *
 from time import time
-import MusicObjects as mus
 import Symbols
-
-# This serves as a lookup dictionary to improve the readability of the addObject
-# code.
-typeLookup = {'dot':mus.NOTE_FILLED,'circle':mus.NOTE_EMPTY,'sharp':mus.ACC_SHARP,'natural':mus.ACC_NATURAL,'flat':mus.ACC_FLAT}
+import Render
+import Documents
+from Pages import Page
+from Geometry import Rect
+from MusicObjects import STAFFSPACING
 
 # TODO: put this in a config/parameters file that can easily be changed.
 CLASSIFYTIMETHRESHOLD = 0.2
@@ -29,174 +34,63 @@ def makeOverlay(size):
 	overlay.fill((0,0,0,0))
 	return overlay
 
-class Page:
-	def __init__(self,pad):
+class Classifier:
+	"""
+	  Classifies finished gestures on a background thread, so that the main
+	  loop keeps capturing ink and updating the screen while it works.
+	  Gestures are classified one at a time, in the order they were submitted,
+	  since where an object is placed can depend on the objects drawn before
+	  it.
+	"""
+	def __init__(self):
+		self._gestures = Queue.Queue()
+		self._results = Queue.Queue()
+		thread = threading.Thread(target=self._run)
+		thread.daemon = True
+		thread.start()
+
+	def submit(self,shape,context):
 		"""
-		  This is a "page" of staff paper.  It has staves, which can contain
-		  notes and other symbols.
-		
-		  It shares common attributes, such as page size, with all the other
-		  pages in the pad.
+		  Queues a gesture to be classified.  The context is returned with the
+		  result, untouched.
 		"""
-		self.pad = pad
+		self._gestures.put((shape,context))
 
-		# A list of the staves on the page
-		# TODO: Eventually, these will probably become systems instead
-		self.staves = []
-
-		# Initialize the page with four staves
-		for i in range(4):
-			s = mus.Staff(None,self.pad.pageSize[0],100*i+110)
-			self.staves.append(s)
-
-	def removeObjectAtPoint(self,point):
-		"""
-		  This function removes any object that is underneath the given point.
+	def results(self):
 		"""
-		redraw = False
-		for staff in self.staves:
-			# redraw if objects are removed
-			remStaff,remChild = staff.removeAt(point)
-			redraw = redraw or remChild
-		self.pad.redraw()
-
-	def addObject(self,type,rect):
+		  Returns the (type,context) of each gesture classified since the last
+		  call, in the order they were submitted.  This never blocks.
 		"""
-		  This function attempts to contain all of the logic for determining
-		  what a given shape (line, circle, etc) actually means musically.
-		  This is probably too much for one function, and should eventually be
-		  broken up into smaller chunks in some intelligent way.
-		"""
-		rect = pygame.Rect(rect[0][0],rect[0][1],rect[1][0]-rect[0][0],rect[1][1]-rect[0][1])
-
-		# Conditions to become a note:
-		# - symbol must be a circle or a dot
-		if type == 'circle' or type == 'dot':
-			# get closest staff to attach note to
-			staff, dist = mus.getClosestStaff(self.staves,rect.center)
-
-			# make note object
-			n = mus.Note(staff,rect.center,typeLookup[type])
-
-			# If there is a stem close, attach note to it
-			# TODO: do this before staff logic (modify MusicObject stem code
-			# to allow this)
-			# TODO: pick other than first? pick closest instead?
-			closeStems = staff.recurseGetIntersectRect(n._rect,mus.Stem)
-			if len(closeStems) != 0:
-				closeStems[0].addNotes([n])
-
-			# Redraw (necessary because note may affect other clustered notes)
-			self.pad.redraw()
-
-		elif type == 'sharp' or type == 'flat' or type == 'natural':
-			centerOffset = (rect.centerx+mus.STAFFSPACING*1.5,rect.centery)
-
-			# get closest staff on which to attach accidental to note
-			staff, dist = mus.getClosestStaff(self.staves,centerOffset)
-
-			r = mus.STAFFSPACING*0.25
-			area = pygame.Rect(centerOffset[0]-r,centerOffset[1]-r,2.0*r,2.0*r)
-			closeNotes = staff.recurseGetIntersectRect(area,mus.Note)
-			# TODO: Should there instead be a recurseGetClosest?
-
-			if len(closeNotes) > 0:
-				a = mus.Accidental(closeNotes[0],typeLookup[type])
-				a.draw(self.pad.background,self.pad.zoom);
-			else:
-				print "nowhere to put " + type
-		elif type == 'sm_dot':
-			centerOffsetR = (rect.centerx-mus.STAFFSPACING*1.0,rect.centery) # In this case, it is a rhythm dot
-			centerOffsetS = (rect.centerx,rect.centery+mus.STAFFSPACING*1.0) # In this case, it is a staccato marking
-
-			# get closest staff on which to attach accidental to note
-			staff, dist = mus.getClosestStaff(self.staves,centerOffsetR)
-
-			r = mus.STAFFSPACING*0.25
-			area = pygame.Rect(centerOffsetR[0]-r,centerOffsetR[1]-r,2.0*r,2.0*r)
-			closeNotes = staff.recurseGetIntersectRect(area,mus.Note)
-
-			if len(closeNotes) > 0:
-				a = mus.Accent(closeNotes[0],mus.ACC_RHYTHM_DOT)
-				a.draw(self.pad.background,self.pad.zoom);
-			else:
-				area = pygame.Rect(centerOffsetS[0]-r,centerOffsetS[1]-r,2.0*r,2.0*r)
-				closeNotes = staff.recurseGetIntersectRect(area,mus.Note)
-				if len(closeNotes) > 0:
-					a = mus.Accent(closeNotes[0],mus.ACC_STACCATO)
-					a.draw(self.pad.background,self.pad.zoom);
-				else:
-					print "nowhere to put " + type
-
-		elif (type == 'hline' and rect.w < 1.5*mus.STAFFSPACING):
-			print "marcato!"
-
-		elif type == 'vline':
-			# Find the closest staff
-			staff, dist = mus.getClosestStaff(self.staves,rect.center)
-
-			# Find the lines which the line starts and ends at
-			endlines = [staff.whichLine(rect.top),staff.whichLine(rect.bottom)]
-
-			# TODO: add all notes, and have stem sort it out?
-			# TODO: choose closest for base?
-			r = mus.STAFFSPACING*0.25
-			closeTopNotes = staff.recurseGetIntersectRect(pygame.Rect(rect.centerx-r,rect.top-r,2.0*r,2.0*r),mus.Note)
-			closeBotNotes = staff.recurseGetIntersectRect(pygame.Rect(rect.centerx-r,rect.bottom-r,2.0*r,2.0*r),mus.Note)
-
-			# If the vertical line's top or bottom is close to a note,
-			# then we make it a stem of that note, TODO: giving preference
-			# to the closest note (bottom if they are equal)
-			if len(closeBotNotes) > 0 or len(closeTopNotes) > 0:
-				stemLen = abs(endlines[0]-endlines[1])
-				if len(closeBotNotes) > 0:
-					stem = mus.Stem(staff,(rect.centerx,closeBotNotes[0]._line),
-					                stemLen,1,[closeBotNotes[0]])
-				else:
-					stem = mus.Stem(staff,(rect.centerx,closeTopNotes[0]._line),
-					                stemLen,-1,[closeTopNotes[0]])
-
-				# Find any other notes within range of the stem and attach them
-				area = pygame.Rect(rect.centerx-mus.STAFFSPACING*0.25,rect.centery-stemLen*0.5,mus.STAFFSPACING*0.5,stemLen)
-
-				chordNotes = staff.recurseGetIntersectRect(area,mus.Note)
-				stem.addNotes(chordNotes)
-
-				# Redraw
-				self.pad.redraw()
-
-			# Otherwise, for it to be a barline, it must start and end
-			# at the staff's top and bottom line
-			# TODO: Change these values to a staff constant, based on 
-			# staff type
-			elif (endlines[0] in [-3,-4,-5] and endlines[1] in [3,4,5]):
-				barline = mus.Barline(staff,rect.centerx)
-				# draw barline
-				barline.draw(self.pad.background,self.pad.zoom);
-			else:
-				print "unrecognized vertical line"
-		elif type == 'hline':
-			if 0:
-				pass
-			else:
-				print "unrecognized horizontal line"
-		elif type == 'rline':
-			print "right line recognized"
-		elif type == 'lline':
-			print "left line recognized"
-		else:
-			print "unhandled shape"
-			# TODO: color unrecognized stuff red?
-
+		results = []
+		while True:
+			try:
+				results.append(self._results.get_nowait())
+			except Queue.Empty:
+				return results
+
+	def _run(self):
+		while True:
+			shape, context = self._gestures.get()
+			try:
+				type = Symbols.classify(shape,cascade=True)
+			except Exception:
+				traceback.print_exc()
+				type = 'unclassified'
+			self._results.put((type,context))
 
 class StaffPad:
-	def __init__(self,width=512,height=512):
+	def __init__(self,width=512,height=512,path=None):
 		"""
 		  Initialize the pad of staff paper.  The pad consists of a collection
 		  of pages.  Also, the pad contains the information about what the
 		  user is looking at (i.e., which page and area the screen should
 		  display).
+
+		  If a path is given, the pad is loaded from that document (if it
+		  exists), and saved to it (see save).
 		"""
+		self.path = path
+
 		# The current zoom setting.
 		self.zoom = 1.0
 		# The number of pixels of drawn lines at a unit zoom setting.
@@ -216,9 +110,12 @@ class StaffPad:
 		# program.  This cursor scales with the zoom.
 		self.mouseSurface = makeOverlay((self.zoom*self.radius*2,self.zoom*self.radius*2))
 
-		# Add an initial page
-		self.pages = [];
-		self.pages.append(Page(self))
+		# Add an initial page, or the document's pages
+		if path is not None and os.path.exists(path):
+			self.pages = Documents.read(path,self)
+		else:
+			self.pages = [];
+			self.pages.append(Page(self))
 
 		# Set the current page you are looking at.
 		self.currentPage = 0
@@ -226,6 +123,9 @@ class StaffPad:
 		# Draw the initial staves onto the screen.
 		self.redraw()
 
+		# Classifies gestures in the background
+		self.classifier = Classifier()
+
 	def resizeScreen(self,newSize):
 		"""
 		  Called during initialization or resizing of the screen, and builds the
@@ -243,6 +143,8 @@ class StaffPad:
 
 		# The background is the surface where recognized objects are displayed
 		self.background = makeBackground(self.screenSize)
+		# Parts of the background are redrawn on this surface (see damage)
+		self.scratch = makeBackground(self.screenSize)
 
 		# The overlay is the surface where the "ink" is displayed as objects
 		# are drawn
@@ -267,8 +169,20 @@ class StaffPad:
 		lastDrawTime = inf
 		waitToFinish = 0
 
-		# stores the coordinates of points along the drawn path
-		shape = [];
+		# stores the coordinates of points along the drawn path (the stroke
+		# also keeps the shape's features up to date as points are added)
+		shape = Symbols.Stroke()
+
+		# The ink of gestures that have been handed to the classifier, but not
+		# yet added to the page, each on its own overlay so that it can be
+		# erased without erasing the ink of the gesture being drawn.
+		pendingInk = []
+
+		# Where the eraser was on the last frame (if it was touching), so that
+		# everything it passed over since then is erased, and the page it is
+		# erasing from
+		eraserPoint = None
+		eraserPage = None
 
 		# Main loop for capturing input
 		looping = True
@@ -282,11 +196,22 @@ class StaffPad:
 					# Alternatively, this could be caught with a "do you want
 					# to save" message.
 					looping = False
+					self.save()
 				# If the window is resized, update the Pygame screen, the
 				# screen area, and cue a redraw
 				if event.type == pygame.VIDEORESIZE:
 					self.resizeScreen(event.size)
 					self.redraw()
+				# Ctrl+Z undoes the last change to the page, and Ctrl+Y (or
+				# Ctrl+Shift+Z) redoes it
+				if event.type == pygame.KEYDOWN and event.mod & pygame.KMOD_CTRL:
+					if event.key == pygame.K_z and not event.mod & pygame.KMOD_SHIFT:
+						self.pages[self.currentPage].undo()
+					elif event.key == pygame.K_y or event.key == pygame.K_z:
+						self.pages[self.currentPage].redo()
+					# Ctrl+S saves the pad
+					elif event.key == pygame.K_s:
+						self.save()
 
 			# Update the tracked mouse position
 			xPrev = xPos
@@ -315,44 +240,77 @@ class StaffPad:
 				waitToFinish = 1
 				lastDrawTime = time()
 
-			# classify the gesture, and add the object.
+			# hand the gesture to the classifier, and start capturing the next
+			# one straight away.
 			elif waitToFinish and time()-lastDrawTime > CLASSIFYTIMETHRESHOLD:
 				waitToFinish = 0
-				# classify the gesture into a shape
-				type = Symbols.classify(shape)
 
-				# get a bounding rectangle for this shape
-				rect = Symbols.boundingBox(shape)
+				# get a bounding rectangle for this shape, and convert screen
+				# coordinates to page coordinates (now, in case the view
+				# changes before the gesture is classified)!
+				pageRect = self.screenToPage(Symbols.boundingBox(shape))
+
+				ink = self.overlay
+				pendingInk.append(ink)
+				self.classifier.submit(shape,(self.currentPage,pageRect,ink))
 
-				# Convert screen coordinates to page coordinates!
-				pageRect = self.screenToPage(rect)
+				# move the ink of the gesture aside, and reset the shape
+				self.overlay = makeOverlay(self.screenSize)
+				shape = Symbols.Stroke()
 
+			# This means the eraser is touching.
+			# Everything erased in one stroke is undone together.
+			if mouseButtons[1]:
+				pagePoint = self.screenToPage([(xPos,yPos)])[0]
+				if eraserPoint is None:
+					eraserPage = self.pages[self.currentPage]
+					eraserPage.history.begin()
+				eraserPage.eraseSegment(eraserPoint or pagePoint,pagePoint)
+				eraserPoint = pagePoint
+			elif eraserPoint is not None:
+				eraserPage.history.end()
+				eraserPoint = None
+
+			# Add the objects for any gestures that have been classified.
+			# While the eraser is touching, they are held in the classifier
+			# until it is lifted, so that they are not made part of the eraser
+			# stroke's change to the page (and undone with it).
+			if eraserPoint is None:
+				classified = self.classifier.results()
+			else:
+				classified = []
+			for type, (page, pageRect, ink) in classified:
 				# Given the classified shape, we must now determine what it
 				# semantically means.  For example, is a vertical line a barline
 				# or a note stem?
 				# This is done at the page level, which means the coordinates
 				# passed in to this function should be page coordinates.
-				self.pages[self.currentPage].addObject(type,pageRect)
-
-				# erase the ink from the gesture, and reset the shape
-				self.overlay.fill((0,0,0,0))
-				shape = []
+				# The page is only changed here, on the main loop, so that it
+				# is never drawn or erased from while it is being changed.
+				self.pages[page].addObject(type,pageRect)
 
-			# This means the eraser is touching.
-			if mouseButtons[1]:
-				pagePoint = self.screenToPage([(xPos,yPos)])[0]
-				self.pages[self.currentPage].removeObjectAtPoint(pagePoint)
+				# erase the ink from the gesture
+				pendingInk.remove(ink)
 
 			# Draw our mouse pointer representation:
 			pygame.draw.circle(self.mouseSurface, pygame.Color("orange"), (int(self.radius),int(self.radius)), int(self.radius))
 
 			# Blit (write) all of the background and overlay data to the screen 
 			self.screen.blit(self.background, (0,0))
+			for ink in pendingInk:
+				self.screen.blit(ink, (0,0))
 			self.screen.blit(self.overlay, (0,0))
 			self.screen.blit(self.mouseSurface, (xPos-self.zoom*self.radius,yPos-self.zoom*self.radius))
 			pygame.display.flip()
 		pygame.quit()
 
+	def save(self):
+		"""
+		  Saves the pages to the pad's document, if it has one.
+		"""
+		if self.path is not None:
+			Documents.write(self.path,self.pages,self.pageSize)
+
 	# This takes a list of points in screen coordinates, and converts to a list
 	# in page coordinates.
 	def screenToPage(self,pointsIn):
@@ -376,9 +334,36 @@ class StaffPad:
 		# First erase, then draw.
 		self.background.fill(pygame.Color("white"))
 		for staff in self.pages[self.currentPage].staves:
-			staff.draw(self.background, self.zoom)
+			Render.draw(staff, self.background, self.zoom)
 		self.screen.blit(self.background, (0,0))
 
+	def drawObject(self,obj):
+		"""
+		  Draws a newly added object (and its children) onto the background,
+		  without redrawing anything else.
+		"""
+		Render.draw(obj, self.background, self.zoom)
+
+	def damage(self,rect):
+		"""
+		  Redraws only the given area of the page (in page coordinates), after
+		  the objects in it have changed.
+		"""
+		# Objects are drawn a little outside of their rects, and ledger lines
+		# reach from notes all the way to their staff, so anything in the
+		# columns around the area could have been drawn into it.  These are
+		# drawn in the same order as a full redraw.  (They are drawn onto a
+		# scratch surface, and only the area is copied, since drawing them
+		# clipped to the area can leave out parts of thick lines.)
+		column = Rect(rect.left-2*STAFFSPACING,rect.top-self.pageSize[1],rect.w+4*STAFFSPACING,rect.h+2*self.pageSize[1])
+		area = pygame.Rect(rect.left*self.zoom,rect.top*self.zoom,rect.w*self.zoom,rect.h*self.zoom)
+		self.scratch.fill(pygame.Color("white"),area)
+		for staff in self.pages[self.currentPage].staves:
+			for obj in staff.recurseGetIntersectRect(column):
+				Render.drawObject(obj, self.scratch, self.zoom)
+		self.background.blit(self.scratch,area,area)
+
 pygame.init()
-pad = StaffPad()
+# The pad is kept in the document given on the command line, if any
+pad = StaffPad(path=sys.argv[1] if len(sys.argv) > 1 else None)
 pad.run()
@@ -5,10 +5,16 @@ it.
 
 import pygame
 import sys
+import os
+import glob
+import json
+import multiprocessing
 from numpy import *
 from time import time
 import MusicObjects
 import Symbols
+import Render
+import Templates
 
 # TODO: put this into config file
 CLASSIFYTIMETHRESHOLD = 0.2
@@ -62,7 +68,7 @@ class Trainer:
 		s = MusicObjects.Staff(None,width,60)
 
 		self.background.fill(pygame.Color("white"))
-		s.draw(self.background, 1.0)
+		Render.draw(s, self.background, 1.0)
 		self.screen.blit(self.background, (0,0))
 
 	def run(self):
@@ -84,8 +90,9 @@ class Trainer:
 		lastDrawTime = inf
 		waitToFinish = 0
 
-		# stores the coordinates of points along the drawn path
-		shape = []
+		# stores the coordinates of points along the drawn path (the stroke
+		# also keeps the shape's features up to date as points are added)
+		shape = Symbols.Stroke()
 
 		# Main loop for capturing input
 		looping = True
@@ -132,7 +139,7 @@ class Trainer:
 				waitToFinish = 0
 
 				if self.symbol == 'classify':
-					print Symbols.classify(shape)
+					print Symbols.classify(shape,cascade=True)
 				else: # Otherwise, train
 					Symbols.train(shape,self.symbol)
 
@@ -141,7 +148,7 @@ class Trainer:
 
 				# erase the ink from the gesture, and reset the shape
 				self.overlay.fill((0,0,0,0))
-				shape = []
+				shape = Symbols.Stroke()
 
 			# Draw our mouse pointer representation:
 			pygame.draw.circle(self.mouseSurface, pygame.Color("orange"),(1,1),1)
@@ -154,12 +161,79 @@ class Trainer:
 		pygame.quit()
 
 
-if len(sys.argv) != 2:
-	print "Usage:"
-	print "   python train.py <symbol>"
-	print " or"
-	print "   python train.py classify"
-	exit()
-pygame.init()
-train = Trainer(sys.argv[1])
-train.run()
+def readStrokes(path):
+	"""
+	  Reads recorded strokes from a JSONL file, or from every .jsonl file in a
+	  directory.  Each line is an object with the stroke's "points" (a list of
+	  [x,y] coordinates) and the "symbol" it was labeled as; if the label is
+	  missing, the name of the file is used (e.g. sharp.jsonl).
+	"""
+	if os.path.isdir(path):
+		files = sorted(glob.glob(os.path.join(path,'*.jsonl')))
+	else:
+		files = [path]
+
+	strokes = []
+	for fileName in files:
+		label = os.path.splitext(os.path.basename(fileName))[0]
+		f = open(fileName)
+		try:
+			for line in f:
+				if line.strip():
+					record = json.loads(line)
+					strokes.append((str(record.get('symbol',label)),record['points']))
+		finally:
+			f.close()
+	return strokes
+
+def strokeFeatures(stroke):
+	"""
+	  Computes the training features of a (symbol, points) stroke.  This runs
+	  in the worker processes of trainBatch.
+	"""
+	symbol, points = stroke
+	xProjNorm, yProjNorm, size = Symbols.projections(points)
+	return symbol, xProjNorm, yProjNorm, size, Symbols.densityGrid(points)
+
+def trainBatch(path,processes=None):
+	"""
+	  Rebuilds the template of every symbol in a set of recorded strokes (see
+	  readStrokes), without a display.  The features are extracted by a pool
+	  of processes (one per core by default), and then all of the templates
+	  are rebuilt in one pass.
+	"""
+	strokes = readStrokes(path)
+
+	pool = multiprocessing.Pool(processes)
+	try:
+		features = pool.map(strokeFeatures,strokes,max(1,len(strokes)//(4*multiprocessing.cpu_count())))
+	finally:
+		pool.close()
+		pool.join()
+
+	samples = zeros(len(features),Templates.SAMPLEDTYPE)
+	for i in range(len(features)):
+		samples[i] = features[i]
+	Symbols.retrain(samples)
+
+	print "Trained " + str(len(samples)) + " strokes of " + str(len(unique(samples['symbol']))) + " symbols"
+
+if __name__ == '__main__':
+	if len(sys.argv) in [3,4] and sys.argv[1] == '--batch':
+		processes = None
+		if len(sys.argv) == 4:
+			processes = int(sys.argv[3])
+		trainBatch(sys.argv[2],processes)
+		exit()
+
+	if len(sys.argv) != 2:
+		print "Usage:"
+		print "   python train.py <symbol>"
+		print " or"
+		print "   python train.py classify"
+		print " or (without a display, from recorded strokes)"
+		print "   python train.py --batch <strokes.jsonl or directory> [processes]"
+		exit()
+	pygame.init()
+	train = Trainer(sys.argv[1])
+	train.run()